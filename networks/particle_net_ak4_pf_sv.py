@@ -21,7 +21,8 @@ def get_model(data_config, **kwargs):
                               use_counts=kwargs.get('use_counts', True),
                               pf_input_dropout=kwargs.get('pf_input_dropout', None),
                               sv_input_dropout=kwargs.get('sv_input_dropout', None),
-                              for_inference=kwargs.get('for_inference', False)
+                              for_inference=kwargs.get('for_inference', False),
+                              checkpoint_edge_convs=kwargs.get('checkpoint_edge_convs', False),
                               )
 
     model_info = {
@@ -26,6 +26,7 @@ def get_model(data_config, **kwargs):
                               pf_input_dropout=kwargs.get('pf_input_dropout', None),
                               sv_input_dropout=kwargs.get('sv_input_dropout', None),
                               for_inference=False,
+                              checkpoint_edge_convs=kwargs.get('checkpoint_edge_convs', False),
                               )
 
     model_info = {
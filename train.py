@@ -15,6 +15,8 @@ from importlib import import_module
 import ast
 from utils.logger import _logger, _configLogger
 from utils.dataset import SimpleIterDataset
+from utils.timer import TimedCollate
+from utils.data.fileio import set_read_threads
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--regression-mode', action='store_true', default=False,
@@ -42,11 +44,20 @@ parser.add_argument('--file-fraction', type=float, default=1,
 parser.add_argument('--fetch-by-files', action='store_true', default=False,
                     help='When enabled, will load all events from a small number (set by ``--fetch-step``) of files for each data fetching. '
                          'Otherwise (default), load a small fraction of events from all files each time, which helps reduce variations in the sample composition.')
-parser.add_argument('--fetch-step', type=float, default=0.01,
+parser.add_argument('--fetch-step', type=lambda x: x if x == 'auto' else float(x), default=0.01,
                     help='fraction of events to load each time from every file (when ``--fetch-by-files`` is disabled); '
-                         'Or: number of files to load each time (when ``--fetch-by-files`` is enabled). Shuffling & sampling is done within these events, so set a large enough value.')
+                         'Or: number of files to load each time (when ``--fetch-by-files`` is enabled). Shuffling & sampling is done within these events, so set a large enough value. '
+                         'Set to `auto` to adapt it on the fly to the measured read throughput, the number of selected events and the memory budget (`--memory-soft-limit`)')
 parser.add_argument('--in-memory', action='store_true', default=False,
                     help='load the whole dataset (and perform the preprocessing) only once and keep it in memory for the entire run')
+parser.add_argument('--shared-memory', action='store_true', default=False,
+                    help='w/ `--in-memory`, load and preprocess the dataset only once per node, into shared memory, '
+                         'for all the data loader workers and all the local ranks (w/ DDP), instead of once per worker')
+parser.add_argument('--read-threads', type=int, default=4,
+                    help='number of threads in each data loader worker used to decompress HDF5 files (blosc), to load the branches of awkd files in parallel and to decode Parquet/Arrow files')
+parser.add_argument('--memory-soft-limit', type=float, default=None,
+                    help='soft limit (in GB) on the memory (RSS) of each data loader worker: `--fetch-step` of the worker is halved '
+                         'whenever its memory usage is above this limit before fetching the next chunk')
 parser.add_argument('--train-val-split', type=float, default=0.8,
                     help='training/validation split fraction')
 parser.add_argument('--demo', action='store_true', default=False,
@@ -102,6 +113,27 @@ parser.add_argument('--batch-size', type=int, default=128,
                     help='batch size')
 parser.add_argument('--use-amp', action='store_true', default=False,
                     help='use mixed precision training (fp16)')
+parser.add_argument('--compile-mode', type=str, default=None, choices=['script', 'compile'],
+                    help='run the model compiled for training and prediction, w/ TorchScript (`script`) or `torch.compile` (`compile`, requires PyTorch 2.0+); '
+                         'the compiled model is checked against the eager model, and falls back to the eager model if the compilation fails')
+parser.add_argument('--grad-accum-steps', type=int, default=1,
+                    help='number of batches to accumulate the gradients over before each optimizer step; '
+                         'the effective batch size becomes `--batch-size` * `--grad-accum-steps`')
+parser.add_argument('--micro-batch-size', type=int, default=None,
+                    help='split each batch into micro-batches of (at most) this size for the forward/backward passes, to reduce the GPU memory usage; '
+                         'batches are also split automatically when running out of GPU memory. '
+                         'Note: the batch normalization statistics are computed per micro-batch')
+parser.add_argument('--weight-averaging', type=str, default=None, choices=['ema', 'swa'],
+                    help='keep an exponential moving average (`ema`) or a plain average (`swa`) of the model weights during the training; '
+                         'the averaged weights are used for validation, and saved to `{model_prefix}_epoch-%%d_averaged_state.pt`')
+parser.add_argument('--weight-averaging-decay', type=float, default=0.999,
+                    help='decay factor of the exponential moving average, only valid for `--weight-averaging ema`')
+parser.add_argument('--weight-averaging-every', type=int, default=1,
+                    help='update the weight average every N optimizer steps')
+parser.add_argument('--async-validation', type=str, default=None,
+                    help='validate each epoch on a snapshot of the weights, on this device (e.g., `cpu`, or a spare gpu such as `3`), '
+                         'in the background while the next epoch trains; the best epoch is updated once each validation is done. '
+                         'W/ `--backend`, only (local) rank 0 validates, on this device, and the other ranks skip the validation')
 parser.add_argument('--gpus', type=str, default='0',
                     help='device for the training/testing; to use CPU, set to empty string (""); to use multiple gpu, set it as a comma separated list, e.g., `1,2,3,4`')
 parser.add_argument('--predict-gpus', type=str, default=None,
@@ -112,19 +144,50 @@ parser.add_argument('--predict', action='store_true', default=False,
                     help='run prediction instead of training')
 parser.add_argument('--predict-output', type=str,
                     help='path to save the prediction output, support `.root` and `.awkd` format')
+parser.add_argument('--predict-merge', action='store_true', default=False,
+                    help='w/ distributed prediction (`--backend`), gather the outputs of all ranks and write them, in the input order, '
+                         'to a single `--predict-output` file on rank 0, instead of one `{predict_output}_rank%%d` file per rank')
 parser.add_argument('--export-onnx', type=str, default=None,
                     help='export the PyTorch model to ONNX model and save it at the given path (path must ends w/ .onnx); '
                          'needs to set `--data-config`, `--network-config`, and `--model-prefix` (requires the full model path)')
+parser.add_argument('--export-onnx-variants', nargs='+', default=[], choices=['int8-dynamic', 'int8-static', 'fp16'],
+                    help='additionally produce quantized (int8) and/or half precision (fp16) variants of the exported ONNX model, '
+                         'saved next to it as `{name}.{variant}.onnx`; the static int8 quantization is calibrated on `--data-test`, '
+                         'and the speed and the score deviation w.r.t. the fp32 model are evaluated on `--data-test` if set')
+parser.add_argument('--export-onnx-calib-batches', type=int, default=10,
+                    help='number of batches from `--data-test` used to calibrate the static int8 quantization')
+parser.add_argument('--export-onnx-eval-batches', type=int, default=20,
+                    help='number of batches from `--data-test` used to compare the ONNX model variants w/ the fp32 model')
 parser.add_argument('--io-test', action='store_true', default=False,
                     help='test throughput of the dataloader')
+parser.add_argument('--benchmark', type=str, default=None,
+                    help='run the benchmark suite on synthetic files generated according to `--data-config` '
+                         '(reader, preprocessing, dataloader w/ various `num_workers`, model forward/backward) '
+                         'and write the report to this JSON file; no input files are needed')
+parser.add_argument('--benchmark-option', nargs=2, action='append', default=[],
+                    help='options of the benchmark suite, e.g., `--benchmark-option num_workers [0,2,4]`; '
+                         'see `default_options` in `utils/benchmark.py`')
+parser.add_argument('--convert-to', type=str, default=None,
+                    help='run the preprocessing once on `--data-train` (or on `--data-test` w/ `--predict`) and write the outputs to '
+                         'preprocessed shards (plus a `manifest.json`) in this directory, using `--num-workers` processes; '
+                         'the shards can then be used as `--data-train`/`--data-test` w/o any preprocessing')
+parser.add_argument('--convert-entries-per-shard', type=int, default=100000,
+                    help='number of entries per shard written by `--convert-to`')
 parser.add_argument('--copy-inputs', action='store_true', default=False,
                     help='copy input files to the current dir (can help to speed up dataloading when running over remote files, e.g., from EOS)')
 parser.add_argument('--log', type=str, default='',
                     help='path to the log file; `{auto}` can be used as part of the path to auto-generate a name, based on the timestamp and network configuration')
 parser.add_argument('--print', action='store_true', default=False,
                     help='do not run training/prediction but only print model information, e.g., FLOPs and number of parameters of a model')
+parser.add_argument('--flops', action='store_true', default=False,
+                    help='count the FLOPs (and the memory traffic) of the model, w/ a forward pass on a copy of it; always done w/ `--print`')
 parser.add_argument('--profile', action='store_true', default=False,
-                    help='run the profiler')
+                    help='run the profiler on training steps (forward, backward and optimizer) w/ real batches from `--data-train`; '
+                         'the time and memory are also broken down per submodule (e.g., each `EdgeConvBlock`, `knn`, `fc`)')
+parser.add_argument('--profile-dir', type=str, default=None,
+                    help='output dir of the profiler traces and summary tables; default: `profile` under the dir of `--model-prefix`')
+parser.add_argument('--profile-steps', type=int, default=6,
+                    help='number of training steps recorded by the profiler (after a few warm-up steps)')
 parser.add_argument('--backend', type=str, choices=['gloo', 'nccl', 'mpi'], default=None,
                     help='backend for distributed training')
 
@@ -154,7 +217,8 @@ def to_filelist(args, mode='train'):
     for name, files in file_dict.items():
         file_dict[name] = sorted(files)
 
-    if args.local_rank is not None:
+    if args.local_rank is not None and not (args.in_memory and args.shared_memory):
+        # (w/ `--shared-memory`, each local rank samples from its own subset of the entries instead)
         if mode == 'train':
             local_world_size = int(os.environ['LOCAL_WORLD_SIZE'])
             new_file_dict = {}
@@ -227,6 +291,8 @@ def train_load(args):
                                    fetch_step=args.fetch_step,
                                    infinity_mode=args.steps_per_epoch is not None,
                                    in_memory=args.in_memory,
+                                   shared_memory=args.shared_memory,
+                                   memory_soft_limit=args.memory_soft_limit,
                                    name='train' + ('' if args.local_rank is None else '_rank%d' % args.local_rank))
     val_data = SimpleIterDataset(val_file_dict, args.data_config, for_training=True,
                                  load_range_and_fraction=(val_range, args.data_fraction),
@@ -235,12 +301,16 @@ def train_load(args):
                                  fetch_step=args.fetch_step,
                                  infinity_mode=args.steps_per_epoch_val is not None,
                                  in_memory=args.in_memory,
+                                 shared_memory=args.shared_memory,
+                                 memory_soft_limit=args.memory_soft_limit,
                                  name='val' + ('' if args.local_rank is None else '_rank%d' % args.local_rank))
     train_loader = DataLoader(train_data, batch_size=args.batch_size, drop_last=True, pin_memory=True,
                               num_workers=min(args.num_workers, int(len(train_files) * args.file_fraction)),
+                              collate_fn=TimedCollate(train_data.timer),
                               persistent_workers=args.num_workers > 0 and args.steps_per_epoch is not None)
     val_loader = DataLoader(val_data, batch_size=args.batch_size, drop_last=True, pin_memory=True,
                             num_workers=min(args.num_workers, int(len(val_files) * args.file_fraction)),
+                            collate_fn=TimedCollate(val_data.timer),
                             persistent_workers=args.num_workers > 0 and args.steps_per_epoch_val is not None)
     data_config = train_data.config
     train_input_names = train_data.config.input_names
@@ -249,12 +319,7 @@ def train_load(args):
     return train_loader, val_loader, data_config, train_input_names, train_label_names
 
 
-def test_load(args):
-    """
-    Loads the test data.
-    :param args:
-    :return: test_loaders, data_config
-    """
+def to_test_filedict(args):
     # keyword-based --data-test: 'a:/path/to/a b:/path/to/b'
     # split --data-test: 'a%10:/path/to/a/*'
     file_dict = {}
@@ -282,17 +347,53 @@ def test_load(args):
         files = file_dict.pop(name)
         for i in range((len(files) + split - 1) // split):
             file_dict[f'{name}_{i}'] = files[i * split:(i + 1) * split]
+    return file_dict
+
+
+def to_rank_shard(filelist, rank, world_size):
+    """
+    Splits a list of test files across the ranks, such that concatenating the outputs of all the ranks (in the order
+    of the ranks) follows the input order: each rank gets a contiguous block of files, or, w/ fewer files than ranks,
+    a contiguous range of entries of a single file.
+    :param filelist:
+    :param rank:
+    :param world_size:
+    :return: filelist, load_range
+    """
+    if len(filelist) == 0:
+        return filelist, (0, 1)
+    if len(filelist) >= world_size:
+        block = np.array_split(np.arange(len(filelist)), world_size)[rank]
+        return [filelist[i] for i in block], (0, 1)
+    for i, ranks in enumerate(np.array_split(np.arange(world_size), len(filelist))):
+        if rank in ranks:
+            j, k = list(ranks).index(rank), len(ranks)
+            return [filelist[i]], (j / k, (j + 1) / k)
+
+
+def test_load(args):
+    """
+    Loads the test data.
+    :param args:
+    :return: test_loaders, data_config
+    """
+    file_dict = to_test_filedict(args)
 
     def get_test_loader(name):
-        filelist = file_dict[name]
-        _logger.info('Running on test file group %s with %d files:\n...%s', name, len(filelist), '\n...'.join(filelist))
+        filelist, load_range = file_dict[name], (0, 1)
+        if args.backend is not None:
+            # distributed prediction: each rank runs on its own shard of the inputs
+            filelist, load_range = to_rank_shard(
+                filelist, torch.distributed.get_rank(), torch.distributed.get_world_size())
+        _logger.info('Running on test file group %s with %d files (range: %s):\n...%s',
+                     name, len(filelist), str(load_range), '\n...'.join(filelist))
         num_workers = min(args.num_workers, len(filelist))
         test_data = SimpleIterDataset({name: filelist}, args.data_config, for_training=False,
-                                      load_range_and_fraction=((0, 1), args.data_fraction),
+                                      load_range_and_fraction=(load_range, args.data_fraction),
                                       fetch_by_files=True, fetch_step=1,
                                       name='test_' + name)
         test_loader = DataLoader(test_data, num_workers=num_workers, batch_size=args.batch_size, drop_last=False,
-                                 pin_memory=True)
+                                 pin_memory=True, collate_fn=TimedCollate(test_data.timer))
         return test_loader
 
     test_loaders = {name: functools.partial(get_test_loader, name) for name in file_dict}
@@ -330,6 +431,20 @@ def onnx(args, model, data_config, model_info):
     data_config.export_json(preprocessing_json)
     _logger.info('Preprocessing parameters saved to %s', preprocessing_json)
 
+    if args.export_onnx_variants:
+        from utils.nn.quantization import quantize_onnx, compare_onnx
+        # builds a fresh loader over the first `--data-test` file group (for the calibration, then the comparison)
+        make_test_loader = next(iter(test_load(args)[0].values())) if args.data_test else None
+        variant_paths = []
+        for variant in args.export_onnx_variants:
+            variant_paths.append(quantize_onnx(
+                args.export_onnx, variant, model_info['input_names'],
+                calib_loader=make_test_loader() if make_test_loader is not None else None,
+                num_calib_batches=args.export_onnx_calib_batches))
+        if make_test_loader is not None:
+            compare_onnx(args.export_onnx, variant_paths, make_test_loader(), model_info['input_names'],
+                         num_batches=args.export_onnx_eval_batches)
+
 
 def flops(model, model_info):
     """
@@ -348,48 +463,173 @@ def flops(model, model_info):
     inputs = tuple(
         torch.ones(model_info['input_shapes'][k], dtype=torch.float32) for k in model_info['input_names'])
 
-    macs, params = get_model_complexity_info(model, inputs, as_strings=True, print_per_layer_stat=True, verbose=True)
+    macs, params, num_bytes = get_model_complexity_info(model, inputs, as_strings=True, print_per_layer_stat=True,
+                                                        verbose=True, with_bytes=True)
     _logger.info('{:<30}  {:<8}'.format('Computational complexity: ', macs))
     _logger.info('{:<30}  {:<8}'.format('Number of parameters: ', params))
+    _logger.info('{:<30}  {:<8}'.format('Memory traffic: ', num_bytes))
 
 
-def profile(args, model, model_info, device):
+def profile(args, model, model_info, loss_func, train_loader, device):
     """
-    Profile.
+    Profile the training steps (forward, backward and optimizer) on real batches from the train loader.
+    :param args:
     :param model:
     :param model_info:
+    :param loss_func:
+    :param train_loader:
+    :param device:
     :return:
     """
-    import copy
+    import json
     from torch.profiler import profile, record_function, ProfilerActivity
+    from utils.nn.profiler import ModuleProfiler, module_summary, format_module_summary
+    from utils.nn.tools import _flatten_label, _flatten_preds
 
-    model = copy.deepcopy(model)
-    model = model.to(device)
-    model.eval()
+    output_dir = args.profile_dir or os.path.join(os.path.dirname(args.model_prefix), 'profile')
+    os.makedirs(output_dir, exist_ok=True)
+    data_config = train_loader.dataset.config
+    label_name = data_config.label_names[0]
 
-    inputs = tuple(
-        torch.ones((args.batch_size,) + model_info['input_shapes'][k][1:],
-                   dtype=torch.float32).to(device) for k in model_info['input_names'])
-    for x in inputs:
-        print(x.shape, x.device)
+    model = model.to(device)
+    model.train()
+    opt, scheduler = optim(args, model, device)
+    grad_scaler = torch.cuda.amp.GradScaler() if args.use_amp else None
+
+    def _loss(model_output, y):
+        if args.regression_mode:
+            return loss_func(model_output.squeeze(-1), y[label_name].float().to(device))
+        try:
+            label_mask = y[label_name + '_mask'].bool()
+        except KeyError:
+            label_mask = None
+        logits = _flatten_preds(model_output, label_mask)
+        return loss_func(logits, _flatten_label(y[label_name].long(), label_mask).to(device))
+
+    activities = [ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(ProfilerActivity.CUDA)
+    sort_by = 'self_cuda_time_total' if device.type == 'cuda' else 'self_cpu_time_total'
 
     def trace_handler(p):
-        output = p.key_averages().table(sort_by="self_cuda_time_total", row_limit=50)
-        print(output)
-        p.export_chrome_trace("/tmp/trace_" + str(p.step_num) + ".json")
-
-    with profile(
-        activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
-        schedule=torch.profiler.schedule(
-            wait=2,
-            warmup=2,
-            active=6,
-            repeat=2),
-        on_trace_ready=trace_handler
-    ) as p:
-        for idx in range(100):
-            model(*inputs)
+        trace_file = os.path.join(output_dir, 'trace_%d.json' % p.step_num)
+        p.export_chrome_trace(trace_file)
+        summary = module_summary(p)
+        with open(os.path.join(output_dir, 'ops_%d.txt' % p.step_num), 'w') as f:
+            f.write(p.key_averages().table(sort_by=sort_by, row_limit=100))
+        with open(os.path.join(output_dir, 'modules_%d.txt' % p.step_num), 'w') as f:
+            f.write(format_module_summary(summary))
+        with open(os.path.join(output_dir, 'modules_%d.json' % p.step_num), 'w') as f:
+            json.dump(summary, f, indent=2)
+        _logger.info('Per-module breakdown over %d training steps (forward+backward):\n%s' %
+                     (args.profile_steps, format_module_summary(summary)))
+        _logger.info('Profiler traces and summary tables written to %s' % output_dir, color='bold')
+
+    wait, warmup = 1, 2
+    with profile(activities=activities,
+                 schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=args.profile_steps, repeat=1),
+                 on_trace_ready=trace_handler, profile_memory=True, record_shapes=True) as p, ModuleProfiler(model):
+        for step, (X, y, _) in enumerate(train_loader):
+            with record_function('h2d'):
+                inputs = [X[k].to(device) for k in data_config.input_names]
+            opt.zero_grad()
+            with record_function('forward'), torch.cuda.amp.autocast(enabled=args.use_amp):
+                loss = _loss(model(*inputs), y)
+            with record_function('backward'):
+                if grad_scaler is None:
+                    loss.backward()
+                else:
+                    grad_scaler.scale(loss).backward()
+            with record_function('optimizer'):
+                if grad_scaler is None:
+                    opt.step()
+                else:
+                    grad_scaler.step(opt)
+                    grad_scaler.update()
+                if scheduler and getattr(scheduler, '_update_per_step', False):
+                    scheduler.step()
             p.step()
+            if step + 1 >= wait + warmup + args.profile_steps:
+                break
+
+
+def compile_model(args, model, model_info, device, num_iters=20):
+    """
+    Compiles the model w/ TorchScript or `torch.compile`, and checks it against the eager model.
+    :param args:
+    :param model:
+    :param model_info:
+    :param device:
+    :return: the compiled model, or the original model if the compilation fails
+    """
+    import time
+
+    def _sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    def _run(m, inputs, n=1):
+        # the model may modify the inputs in place (e.g., masking), so always pass copies
+        for _ in range(n):
+            output = m(*[x.clone() for x in inputs])
+        return output
+
+    def _benchmark(m, inputs):
+        _run(m, inputs, 3)  # warm-up
+        _sync()
+        start = time.time()
+        _run(m, inputs, num_iters)
+        _sync()
+        return num_iters * args.batch_size / (time.time() - start)
+
+    _logger.info('Compiling the model w/ mode `%s`' % args.compile_mode)
+    training = model.training
+    inputs = _example_inputs(model_info, args.batch_size, device)
+    try:
+        if args.compile_mode == 'script':
+            compiled_model = torch.jit.script(model)
+        elif args.compile_mode == 'compile':
+            if not hasattr(torch, 'compile'):
+                raise RuntimeError('`torch.compile` requires PyTorch 2.0+')
+            compiled_model = torch.compile(model)
+        # compare w/ the eager model in eval mode (no dropout, fixed BN stats)
+        model.eval()
+        with torch.no_grad():
+            ref_output = _run(model, inputs)
+            output = _run(compiled_model, inputs)
+            if not torch.allclose(output.float(), ref_output.float(), rtol=1e-3, atol=1e-5):
+                raise RuntimeError('Compiled model output does not match the eager model (max abs diff: %s)' %
+                                   (output.float() - ref_output.float()).abs().max().item())
+            eager_speed = _benchmark(model, inputs)
+            compiled_speed = _benchmark(compiled_model, inputs)
+        _logger.info('Model compiled w/ mode `%s`: output matches the eager model; throughput (eval, batch_size=%d): '
+                     'eager %.1f entries/s, compiled %.1f entries/s (x%.2f)' %
+                     (args.compile_mode, args.batch_size, eager_speed, compiled_speed, compiled_speed / eager_speed),
+                     color='bold')
+    except Exception:
+        import traceback
+        _logger.warning('Failed to compile the model w/ mode `%s`, will fall back to the eager model:\n%s' %
+                        (args.compile_mode, traceback.format_exc()))
+        compiled_model = model
+    finally:
+        model.train(training)
+    compiled_model.train(training)
+    return compiled_model
+
+
+def _example_inputs(model_info, batch_size, device):
+    """
+    Random inputs w/ zero-padding at the end of the last (i.e., particle) axis, so the masking is exercised.
+    """
+    inputs = []
+    for k in model_info['input_names']:
+        shape = (batch_size,) + tuple(model_info['input_shapes'][k][1:])
+        lengths = torch.randint(1, shape[-1] + 1, (batch_size, 1))
+        valid = (torch.arange(shape[-1]).view(1, -1) < lengths).float()  # (N, P)
+        x = torch.ones(shape) if k.endswith('_mask') else torch.randn(shape)
+        x *= valid.view((batch_size,) + (1,) * (len(shape) - 2) + (shape[-1],))
+        inputs.append(x.to(device))
+    return inputs
 
 
 def optim(args, model, device):
@@ -466,9 +706,9 @@ def optim(args, model, device):
         _logger.info('Resume training from epoch %d' % args.load_epoch)
         model_state = torch.load(args.model_prefix + '_epoch-%d_state.pt' % args.load_epoch, map_location=device)
         if isinstance(model, torch.nn.parallel.DistributedDataParallel):
-            model.module.load_state_dict(model_state)
-        else:
-            model.load_state_dict(model_state)
+            model = model.module
+        # `torch.compile` wraps the original model in `_orig_mod`
+        getattr(model, '_orig_mod', model).load_state_dict(model_state)
         opt_state_file = args.model_prefix + '_epoch-%d_optimizer.pt' % args.load_epoch
         if os.path.exists(opt_state_file):
             opt_state = torch.load(opt_state_file, map_location=device)
@@ -476,6 +716,11 @@ def optim(args, model, device):
         else:
             _logger.warning('Optimizer state file %s NOT found!' % opt_state_file)
 
+    # per-step schedulers are stepped once per optimizer step, i.e., every `--grad-accum-steps` batches
+    opt_steps_per_epoch = None
+    if args.steps_per_epoch is not None:
+        opt_steps_per_epoch = math.ceil(args.steps_per_epoch / args.grad_accum_steps)
+
     scheduler = None
     if args.lr_finder is None:
         if args.lr_scheduler == 'steps':
@@ -497,7 +742,7 @@ def optim(args, model, device):
                     opt, milestones=milestones, gamma=gamma,
                     last_epoch=-1 if args.load_epoch is None else args.load_epoch)
         elif args.lr_scheduler == 'flat+linear' or args.lr_scheduler == 'flat+cos':
-            total_steps = args.num_epochs * args.steps_per_epoch
+            total_steps = args.num_epochs * opt_steps_per_epoch
             warmup_steps = args.warmup_steps
             flat_steps = total_steps * 0.7 - 1
             min_factor = 0.001
@@ -518,11 +763,11 @@ def optim(args, model, device):
                     return max(min_factor, 0.5 * (math.cos(math.pi * pct) + 1))
 
             scheduler = torch.optim.lr_scheduler.LambdaLR(
-                opt, lr_fn, last_epoch=-1 if args.load_epoch is None else args.load_epoch * args.steps_per_epoch)
+                opt, lr_fn, last_epoch=-1 if args.load_epoch is None else args.load_epoch * opt_steps_per_epoch)
             scheduler._update_per_step = True  # mark it to update the lr every step, instead of every epoch
         elif args.lr_scheduler == 'one-cycle':
             scheduler = torch.optim.lr_scheduler.OneCycleLR(
-                opt, max_lr=args.start_lr, epochs=args.num_epochs, steps_per_epoch=args.steps_per_epoch, pct_start=0.3,
+                opt, max_lr=args.start_lr, epochs=args.num_epochs, steps_per_epoch=opt_steps_per_epoch, pct_start=0.3,
                 anneal_strategy='cos', div_factor=25.0, last_epoch=-1 if args.load_epoch is None else args.load_epoch)
             scheduler._update_per_step = True  # mark it to update the lr every step, instead of every epoch
     return opt, scheduler
@@ -549,7 +794,8 @@ def model_setup(args, data_config):
         _logger.info('Model initialized with weights from %s\n ... Missing: %s\n ... Unexpected: %s' %
                      (args.load_model_weights, missing_keys, unexpected_keys))
     # _logger.info(model)
-    flops(model, model_info)
+    if args.flops or args.print:
+        flops(model, model_info)
     # loss function
     try:
         loss_func = network_module.get_loss(data_config, **network_options)
@@ -561,6 +807,40 @@ def model_setup(args, data_config):
     return model, model_info, loss_func
 
 
+def benchmark(args, device):
+    """
+    Benchmark the full pipeline on synthetic data.
+    :param args:
+    :param device:
+    :return:
+    """
+    from utils.benchmark import run_benchmark, log_report, write_report
+    benchmark_options = {k: ast.literal_eval(v) for k, v in args.benchmark_option}
+    _logger.info('Benchmark options: %s' % str(benchmark_options))
+    report = run_benchmark(args.data_config, functools.partial(model_setup, args), device,
+                           batch_size=args.batch_size, fetch_step=args.fetch_step,
+                           regression_mode=args.regression_mode, use_amp=args.use_amp, **benchmark_options)
+    report['meta']['network_config'] = args.network_config
+    report['meta']['network_option'] = args.network_option
+    log_report(report)
+    write_report(report, args.benchmark)
+
+
+def convert(args):
+    """
+    Converts the input files to preprocessed shards.
+    :param args:
+    :return:
+    """
+    from utils.convert import convert_to_shards
+    if args.predict:
+        file_dict = to_test_filedict(args)
+    else:
+        file_dict, _ = to_filelist(args, 'train')
+    convert_to_shards(file_dict, args.data_config, args.convert_to, for_training=not args.predict,
+                      entries_per_shard=args.convert_entries_per_shard, num_workers=args.num_workers)
+
+
 def iotest(args, data_loader):
     """
     Io test
@@ -646,6 +926,25 @@ def save_awk(args, output_path, scores, labels, observers):
     awkward.save(output_path, output, mode='w')
 
 
+def gather_outputs(scores, labels, observers):
+    """
+    Gathers the prediction outputs of all the ranks on rank 0, concatenated in the order of the ranks.
+    :param scores:
+    :param labels:
+    :param observers:
+    :return: scores, labels, observers (`None` on the other ranks)
+    """
+    from utils.data.tools import _concat
+    outputs = [None] * torch.distributed.get_world_size() if torch.distributed.get_rank() == 0 else None
+    torch.distributed.gather_object((scores, labels, observers), outputs, dst=0)
+    if outputs is None:
+        return None, None, None
+    scores = _concat([o[0] for o in outputs])
+    labels = {k: _concat([o[1][k] for o in outputs]) for k in labels}
+    observers = {k: _concat([o[2][k] for o in outputs]) for k in observers}
+    return scores, labels, observers
+
+
 def main(args):
     _logger.info('args:\n - %s', '\n - '.join(str(it) for it in args.__dict__.items()))
 
@@ -682,8 +981,21 @@ def main(args):
         gpus = None
         dev = torch.device('cpu')
 
+    set_read_threads(args.read_threads)
+
+    if args.benchmark:
+        benchmark(args, dev)
+        return
+
+    if args.convert_to:
+        convert(args)
+        return
+
     # load data
-    if training_mode:
+    if args.export_onnx or args.print:
+        # only the data config is needed
+        data_config = SimpleIterDataset({}, args.data_config, for_training=False).config
+    elif training_mode:
         train_loader, val_loader, data_config, train_input_names, train_label_names = train_load(args)
     else:
         test_loaders, data_config = test_load(args)
@@ -703,7 +1015,9 @@ def main(args):
         return
 
     if args.profile:
-        profile(args, model, model_info, device=dev)
+        if not training_mode:
+            raise RuntimeError('`--profile` runs the training steps on real batches, please set `--data-train`.')
+        profile(args, model, model_info, loss_func, train_loader, device=dev)
         return
 
     # export to ONNX
@@ -724,9 +1038,15 @@ def main(args):
     if training_mode:
         model = orig_model.to(dev)
 
-        # DistributedDataParallel
         if args.backend is not None:
             model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+
+        # the compiled model shares the parameters w/ `orig_model`
+        if args.compile_mode:
+            model = compile_model(args, model, model_info, dev)
+
+        # DistributedDataParallel
+        if args.backend is not None:
             model = torch.nn.parallel.DistributedDataParallel(model, device_ids=gpus, output_device=local_rank)
 
         # optimizer & learning rate
@@ -749,8 +1069,53 @@ def main(args):
             lr_finder.plot(output='lr_finder.png')  # to inspect the loss-learning rate graph
             return
 
+        # weight averaging: always tracks the original model (not the DataParallel/DDP wrapper)
+        weight_averager = None
+        if args.weight_averaging:
+            from utils.nn.ema import WeightAverager
+            weight_averager = WeightAverager(orig_model, mode=args.weight_averaging,
+                                             decay=args.weight_averaging_decay,
+                                             update_every=args.weight_averaging_every)
+            if args.load_epoch is not None:
+                averaged_state_file = args.model_prefix + '_epoch-%d_averaged_state.pt' % args.load_epoch
+                if os.path.exists(averaged_state_file):
+                    weight_averager.load_state_dict(torch.load(averaged_state_file, map_location=dev))
+                else:
+                    _logger.warning('Averaged weights file %s NOT found!' % averaged_state_file)
+
         # training loop
         best_valid_metric = np.inf if args.regression_mode else 0
+
+        def update_best_epoch(epoch, valid_metric, validated_model):
+            nonlocal best_valid_metric
+            is_best_epoch = (
+                valid_metric < best_valid_metric) if args.regression_mode else(
+                valid_metric > best_valid_metric)
+            if is_best_epoch:
+                best_valid_metric = valid_metric
+                if args.model_prefix and (args.backend is None or local_rank == 0):
+                    if weight_averager is None:
+                        shutil.copy2(args.model_prefix + '_epoch-%d_state.pt' %
+                                     epoch, args.model_prefix + '_best_epoch_state.pt')
+                    else:
+                        # the validated model holds the averaged weights
+                        torch.save(validated_model.state_dict(), args.model_prefix + '_best_epoch_state.pt')
+                    torch.save(validated_model, args.model_prefix + '_best_epoch_full.pt')
+            _logger.info('Epoch #%d: Current validation metric: %.5f (best: %.5f)' %
+                         (epoch, valid_metric, best_valid_metric), color='bold')
+
+        validator = None
+        if args.async_validation and (args.backend is None or local_rank == 0):
+            # w/ DDP, every rank would validate on the same device, all w/ the same (not split) validation files: only
+            # the rank writing the best epoch does
+            import copy
+            from utils.nn.validation import BackgroundValidator
+            val_dev = torch.device(int(args.async_validation) if args.async_validation.isdigit() else args.async_validation)
+            val_loss_func = copy.deepcopy(loss_func).to(val_dev) if isinstance(
+                loss_func, torch.nn.Module) else loss_func
+            validator = BackgroundValidator(orig_model, evaluate, val_dev, callback=update_best_epoch)
+            _logger.info('Validating in the background on %s' % str(val_dev))
+
         grad_scaler = torch.cuda.amp.GradScaler() if args.use_amp else None
         for epoch in range(args.num_epochs):
             if args.load_epoch is not None:
@@ -759,43 +1124,57 @@ def main(args):
             _logger.info('-' * 50)
             _logger.info('Epoch #%d training' % epoch)
             train(model, loss_func, opt, scheduler, train_loader, dev, epoch,
-                  steps_per_epoch=args.steps_per_epoch, grad_scaler=grad_scaler, tb_helper=tb)
+                  steps_per_epoch=args.steps_per_epoch, grad_scaler=grad_scaler, tb_helper=tb,
+                  weight_averager=weight_averager, grad_accum_steps=args.grad_accum_steps,
+                  micro_batch_size=args.micro_batch_size)
             if args.model_prefix and (args.backend is None or local_rank == 0):
                 dirname = os.path.dirname(args.model_prefix)
                 if dirname and not os.path.exists(dirname):
                     os.makedirs(dirname)
-                state_dict = model.module.state_dict() if isinstance(
-                    model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)) else model.state_dict()
+                state_dict = orig_model.state_dict()
                 torch.save(state_dict, args.model_prefix + '_epoch-%d_state.pt' % epoch)
                 torch.save(opt.state_dict(), args.model_prefix + '_epoch-%d_optimizer.pt' % epoch)
+                if weight_averager is not None:
+                    torch.save(weight_averager.state_dict(), args.model_prefix + '_epoch-%d_averaged_state.pt' % epoch)
             # if args.backend is not None and local_rank == 0:
             # TODO: save checkpoint
             #     save_checkpoint()
 
+            if args.async_validation:
+                if validator is not None:
+                    # waits for the validation of the previous epoch (if still running), then returns right away
+                    _logger.info('Epoch #%d validating in the background' % epoch)
+                    validator.submit(epoch, val_loader, weight_averager=weight_averager, loss_func=val_loss_func,
+                                     steps_per_epoch=args.steps_per_epoch_val, tb_helper=tb)
+                continue
+
             _logger.info('Epoch #%d validating' % epoch)
+            if weight_averager is not None:
+                # validate w/ the averaged weights swapped in (no copy)
+                weight_averager.swap()
             valid_metric = evaluate(model, val_loader, dev, epoch, loss_func=loss_func,
                                     steps_per_epoch=args.steps_per_epoch_val, tb_helper=tb)
-            is_best_epoch = (
-                valid_metric < best_valid_metric) if args.regression_mode else(
-                valid_metric > best_valid_metric)
-            if is_best_epoch:
-                best_valid_metric = valid_metric
-                if args.model_prefix and (args.backend is None or local_rank == 0):
-                    shutil.copy2(args.model_prefix + '_epoch-%d_state.pt' %
-                                 epoch, args.model_prefix + '_best_epoch_state.pt')
-                    torch.save(model, args.model_prefix + '_best_epoch_full.pt')
-            _logger.info('Epoch #%d: Current validation metric: %.5f (best: %.5f)' %
-                         (epoch, valid_metric, best_valid_metric), color='bold')
+            update_best_epoch(epoch, valid_metric, orig_model)
+            if weight_averager is not None:
+                weight_averager.swap()
+
+        if validator is not None:
+            validator.wait()
 
     if args.data_test:
-        if args.backend is not None and local_rank != 0:
-            return
         if training_mode:
             del train_loader, val_loader
+            if args.backend is not None:
+                # the best epoch is written by rank 0
+                torch.distributed.barrier()
             test_loaders, data_config = test_load(args)
 
         if not args.model_prefix.endswith('.onnx'):
-            if args.predict_gpus:
+            if args.backend is not None:
+                # distributed prediction: one device per rank
+                gpus = None
+                dev = torch.device(local_rank)
+            elif args.predict_gpus:
                 gpus = [int(i) for i in args.predict_gpus.split(',')]
                 dev = torch.device(gpus[0])
             else:
@@ -806,6 +1185,9 @@ def main(args):
                 '.pt') else args.model_prefix + '_best_epoch_state.pt'
             _logger.info('Loading model %s for eval' % model_path)
             model.load_state_dict(torch.load(model_path, map_location=dev))
+            if args.compile_mode:
+                model.eval()
+                model = compile_model(args, model, model_info, dev)
             if gpus is not None and len(gpus) > 1:
                 model = torch.nn.DataParallel(model, device_ids=gpus)
             model = model.to(dev)
@@ -823,6 +1205,15 @@ def main(args):
             _logger.info('Test metric %.5f' % test_metric, color='bold')
             del test_loader
 
+            rank_suffix = ''
+            if args.backend is not None:
+                if args.predict_merge and args.predict_output:
+                    scores, labels, observers = gather_outputs(scores, labels, observers)
+                    if scores is None:
+                        continue
+                else:
+                    rank_suffix = '_rank%d' % torch.distributed.get_rank()
+
             if args.predict_output:
                 if '/' not in args.predict_output:
                     args.predict_output = os.path.join(
@@ -834,6 +1225,9 @@ def main(args):
                 else:
                     base, ext = os.path.splitext(args.predict_output)
                     output_path = base + '_' + name + ext
+                if rank_suffix:
+                    base, ext = os.path.splitext(output_path)
+                    output_path = base + rank_suffix + ext
                 if output_path.endswith('.root'):
                     save_root(args, output_path, data_config, scores, labels, observers)
                 else:
@@ -856,6 +1250,9 @@ if __name__ == '__main__':
         else:
             raise RuntimeError('Please use either `--steps-per-epoch-val` or `--samples-per-epoch-val`, but not both!')
 
+    if args.grad_accum_steps < 1:
+        raise RuntimeError('`--grad-accum-steps` must be a positive integer!')
+
     if args.steps_per_epoch_val is None and args.steps_per_epoch is not None:
         args.steps_per_epoch_val = round(args.steps_per_epoch * (1 - args.train_val_split) / args.train_val_split)
     if args.steps_per_epoch_val is not None and args.steps_per_epoch_val < 0:
@@ -0,0 +1,255 @@
+import os
+import time
+import json
+import shutil
+import socket
+import tempfile
+import traceback
+import torch
+from torch.utils.data import DataLoader
+
+from .logger import _logger
+from .timer import StageTimer, TimedCollate
+from .dataset import SimpleIterDataset, _preprocess, _num_entries
+from .data.fileio import _read_files
+from .data.config import DataConfig
+from .data.synthetic import write_synthetic_files
+
+default_options = {
+    'formats': ['root', 'h5', 'awkd'],
+    'num_files': 4,
+    'entries_per_file': 10000,
+    'multiplicity': 0.4,
+    'num_workers': [0, 1, 2, 4],
+    'num_batches': 50,
+    'num_model_steps': 20,
+    'work_dir': None,
+    'keep_files': False,
+}
+
+
+def _sync(dev):
+    if dev.type == 'cuda':
+        torch.cuda.synchronize(dev)
+
+
+def _bench_read(data_config, filelist):
+    start = time.perf_counter()
+    table = _read_files(filelist, data_config.load_branches, treename=data_config.treename,
+                        float_branches=data_config.float_branches)
+    elapsed = time.perf_counter() - start
+    num_bytes = sum(os.path.getsize(f) for f in filelist)
+    return table, {'entries': _num_entries(table), 'time': elapsed,
+                   'entries_per_s': _num_entries(table) / elapsed, 'MB_per_s': num_bytes / 1e6 / elapsed}
+
+
+def _bench_preprocess(table, data_config, options):
+    timer = StageTimer(SimpleIterDataset.timer_stages)
+    num_entries = _num_entries(table)
+    start = time.perf_counter()
+    indices = _preprocess(table, data_config, options, timer=timer)
+    elapsed = time.perf_counter() - start
+    return {'entries': num_entries, 'selected': len(indices), 'time': elapsed,
+            'entries_per_s': num_entries / elapsed, 'stages': timer.summary()}
+
+
+def _bench_loader(data_config_file, filelist, num_workers, batch_size, num_batches, fetch_step):
+    dataset = SimpleIterDataset({'_': filelist}, data_config_file, for_training=True,
+                                load_range_and_fraction=((0, 1), 1), fetch_step=fetch_step,
+                                infinity_mode=True, name='benchmark_nw%d' % num_workers)
+    loader = DataLoader(dataset, batch_size=batch_size, drop_last=True, pin_memory=True, num_workers=num_workers,
+                        collate_fn=TimedCollate(dataset.timer), persistent_workers=False)
+    start = time.perf_counter()
+    it = iter(loader)
+    next(it)
+    startup = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        next(it)
+    elapsed = time.perf_counter() - start
+    del it
+    return {'startup_time': startup, 'batches': num_batches, 'time': elapsed,
+            'batches_per_s': num_batches / elapsed, 'entries_per_s': num_batches * batch_size / elapsed,
+            'stages': dataset.timer.summary()}
+
+
+def _bench_model(model, loss_func, batches, data_config, dev, regression_mode=False, use_amp=False):
+    model = model.to(dev)
+    inputs = [[X[k].to(dev) for k in data_config.input_names] for X, _, _ in batches]
+    labels = [y[data_config.label_names[0]].to(dev) for _, y, _ in batches]
+    labels = [y.float() if regression_mode else y.long() for y in labels]
+    batch_size = len(labels[0])
+    results = {}
+
+    # the model may modify the inputs in place (e.g., masking), so always pass copies
+    model.eval()
+    with torch.no_grad(), torch.cuda.amp.autocast(enabled=use_amp):
+        model(*[x.clone() for x in inputs[0]])  # warm-up
+        _sync(dev)
+        start = time.perf_counter()
+        for x in inputs:
+            model(*[t.clone() for t in x])
+        _sync(dev)
+    elapsed = time.perf_counter() - start
+    results['forward'] = {'steps': len(inputs), 'time': elapsed, 'entries_per_s': len(inputs) * batch_size / elapsed}
+
+    model.train()
+
+    def _step(x, y):
+        with torch.cuda.amp.autocast(enabled=use_amp):
+            output = model(*[t.clone() for t in x])
+            loss = loss_func(output.squeeze(-1) if regression_mode else output, y)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    if dev.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(dev)
+    _step(inputs[0], labels[0])  # warm-up
+    _sync(dev)
+    start = time.perf_counter()
+    for x, y in zip(inputs, labels):
+        _step(x, y)
+    _sync(dev)
+    elapsed = time.perf_counter() - start
+    results['forward_backward'] = {'steps': len(inputs), 'time': elapsed,
+                                   'entries_per_s': len(inputs) * batch_size / elapsed}
+    if dev.type == 'cuda':
+        results['forward_backward']['max_memory_allocated_MB'] = torch.cuda.max_memory_allocated(dev) / 1e6
+    return results
+
+
+def _run(name, fn, *args, **kwargs):
+    _logger.info('[benchmark] running %s' % name)
+    try:
+        result = fn(*args, **kwargs)
+    except Exception:
+        _logger.error('[benchmark] %s failed:\n%s' % (name, traceback.format_exc()))
+        return None, {'error': traceback.format_exc().strip().splitlines()[-1]}
+    return result, None
+
+
+def run_benchmark(data_config_file, model_setup, dev, batch_size=128, fetch_step=0.01, regression_mode=False,
+                  use_amp=False, **kwargs):
+    r"""Benchmark the full pipeline on synthetic files generated according to ``data_config_file``.
+
+    Measures the reader and the preprocessing throughput, the DataLoader throughput for each ``num_workers``
+    (for each file format), and the model forward and forward+backward throughput.
+
+    Arguments:
+        data_config_file (str): YAML file containing data format information.
+        model_setup (callable): ``model_setup(data_config)`` returns ``(model, model_info, loss_func)``.
+        dev (torch.device): the device to run the model on.
+        kwargs: overrides of ``default_options``.
+
+    Returns:
+        report (dict): the machine-readable benchmark report.
+    """
+    options = dict(default_options)
+    for k, v in kwargs.items():
+        if k not in options:
+            raise ValueError('Invalid benchmark option: %s' % k)
+        options[k] = v
+    work_dir = options['work_dir'] or tempfile.mkdtemp(prefix='weaver_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    # use a copy of the data config, so the auto-generated preprocessing info does not end up next to the original one
+    bench_config_file = os.path.join(work_dir, os.path.basename(data_config_file))
+    shutil.copy2(data_config_file, bench_config_file)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'host': socket.gethostname(),
+            'torch': torch.__version__,
+            'device': str(dev) if dev.type != 'cuda' else torch.cuda.get_device_name(dev),
+            'cpu_count': os.cpu_count(),
+            'data_config': data_config_file,
+            'batch_size': batch_size,
+            'fetch_step': fetch_step,
+            'options': options,
+        },
+        'generate': {}, 'read': {}, 'preprocess': {}, 'dataloader': {}, 'model': {},
+    }
+    data_config = DataConfig.load(bench_config_file)
+    batches = None
+    for fmt in options['formats']:
+        start = time.perf_counter()
+        filelist, err = _run('generate (%s)' % fmt, write_synthetic_files, data_config, os.path.join(work_dir, fmt),
+                             fmt=fmt, num_files=options['num_files'], entries_per_file=options['entries_per_file'],
+                             multiplicity=options['multiplicity'])
+        report['generate'][fmt] = err or {'time': time.perf_counter() - start,
+                                          'MB': sum(os.path.getsize(f) for f in filelist) / 1e6}
+        if err:
+            continue
+
+        # the dataset also produces the standardization/reweighting info (if needed) for the synthetic data
+        dataset, err = _run('dataset setup (%s)' % fmt, SimpleIterDataset, {'_': filelist}, bench_config_file,
+                            for_training=True)
+        if err:
+            report['read'][fmt] = report['preprocess'][fmt] = err
+            continue
+        result, err = _run('read (%s)' % fmt, _bench_read, dataset.config, filelist)
+        if err:
+            report['read'][fmt] = report['preprocess'][fmt] = err
+        else:
+            table, report['read'][fmt] = result
+            result, err = _run('preprocess (%s)' % fmt, _bench_preprocess, table, dataset.config,
+                               dataset._sampler_options)
+            report['preprocess'][fmt] = err or result
+            del table
+
+        report['dataloader'][fmt] = {}
+        for nw in options['num_workers']:
+            if nw > len(filelist):
+                _logger.warning('[benchmark] skipping num_workers=%d: only %d files', nw, len(filelist))
+                continue
+            result, err = _run('dataloader (%s, num_workers=%d)' % (fmt, nw), _bench_loader, bench_config_file,
+                               filelist, nw, batch_size, options['num_batches'], fetch_step)
+            report['dataloader'][fmt][nw] = err or result
+
+        if batches is None:
+            it = iter(DataLoader(dataset, batch_size=batch_size, drop_last=True, num_workers=0))
+            batches, err = _run('batches for the model (%s)' % fmt,
+                                lambda: [next(it) for _ in range(options['num_model_steps'])])
+            batch_config = dataset.config
+            del it
+
+    if batches is not None:
+        result, err = _run('model setup', model_setup, batch_config)
+        if not err:
+            model, model_info, loss_func = result
+            result, err = _run('model', _bench_model, model, loss_func, batches, batch_config, dev,
+                               regression_mode=regression_mode, use_amp=use_amp)
+        report['model'] = err or result
+    else:
+        report['model'] = {'error': 'No data available'}
+
+    if not options['keep_files']:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def log_report(report):
+    lines = []
+    for fmt, r in report['read'].items():
+        if 'entries_per_s' in r:
+            lines.append('read (%s): %.1f entries/s, %.1f MB/s' % (fmt, r['entries_per_s'], r['MB_per_s']))
+    for fmt, r in report['preprocess'].items():
+        if r and 'entries_per_s' in r:
+            lines.append('preprocess (%s): %.1f entries/s' % (fmt, r['entries_per_s']))
+    for fmt, rs in report['dataloader'].items():
+        for nw, r in rs.items():
+            if 'entries_per_s' in r:
+                lines.append('dataloader (%s, num_workers=%d): %.1f entries/s' % (fmt, nw, r['entries_per_s']))
+    for k, r in report['model'].items():
+        if isinstance(r, dict) and 'entries_per_s' in r:
+            lines.append('model %s: %.1f entries/s' % (k, r['entries_per_s']))
+    _logger.info('Benchmark results:\n - %s', '\n - '.join(lines), color='bold')
+
+
+def write_report(report, output):
+    dirname = os.path.dirname(output)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    _logger.info('Benchmark report written to %s' % output)
@@ -0,0 +1,102 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from .logger import _logger
+from .dataset import SimpleIterDataset, _transform, _num_entries
+from .data.config import _md5
+from .data.fileio import _read_files
+from .data.shards import write_shard, write_manifest, MANIFEST_NAME
+
+
+def _shard_name(group, task, index):
+    prefix = group.strip('_')
+    return '%s%03d_%04d.h5' % (prefix + '_' if prefix else 'shard_', task, index)
+
+
+def _convert_files(task, group, filelist, data_config, options, output_dir, entries_per_shard, info):
+    shards, buffer = [], []
+
+    def _flush():
+        table = {k: np.concatenate([t[k] for t in buffer]) for k in buffer[0]}
+        filepath = os.path.join(output_dir, _shard_name(group, task, len(shards)))
+        write_shard(filepath, table, data_config, info)
+        shards.append({'path': os.path.basename(filepath), 'group': group, 'entries': _num_entries(table)})
+        buffer.clear()
+
+    for filepath in filelist:
+        table = _read_files([filepath], data_config.load_branches, treename=data_config.treename,
+                            selection=data_config.selection if options['training'] else data_config.test_time_selection,
+                            float_branches=data_config.float_branches)
+        if _transform(table, data_config, options) == 0:
+            continue
+        # write full shards, carrying the remainder over to the next file
+        while _num_entries(table) > 0:
+            room = entries_per_shard - sum(_num_entries(t) for t in buffer)
+            buffer.append({k: v[:room] for k, v in table.items()})
+            table = {k: v[room:] for k, v in table.items()}
+            if sum(_num_entries(t) for t in buffer) >= entries_per_shard:
+                _flush()
+    if buffer:
+        _flush()
+    return shards
+
+
+def convert_to_shards(file_dict, data_config_file, output_dir, for_training=True, entries_per_shard=100000,
+                      num_workers=1):
+    r"""Run the preprocessing of ``SimpleIterDataset`` (selection, new variables, labels, weights, standardization,
+    padding and stacking) once, and write the outputs to fixed-shape, chunk-compressed shards of
+    ``entries_per_shard`` entries, plus a manifest listing them. The sampling and the shuffling are left for the
+    training, which reads the shards w/o any other preprocessing.
+
+    Arguments:
+        file_dict (dict): dictionary of lists of files to be converted.
+        data_config_file (str): YAML file containing data format information.
+        for_training (bool): convert for training (w/ the weights) or for testing (w/ the observers, and the
+            ``test_time_selection``).
+        output_dir (str): output directory.
+        entries_per_shard (int): number of entries per shard.
+        num_workers (int): number of processes; the files of each group are split into contiguous blocks.
+
+    Returns:
+        manifest (dict): the content of the manifest.
+    """
+    # resolve the data config (e.g., produce the standardization/reweighting info) as for the training
+    dataset = SimpleIterDataset(file_dict, data_config_file, for_training=for_training)
+    if dataset._sampler_options['preprocessed']:
+        raise RuntimeError('The input files are already preprocessed shards')
+    data_config, options = dataset.config, dataset._sampler_options
+    os.makedirs(output_dir, exist_ok=True)
+    info = {'mode': 'train' if for_training else 'test', 'data_config_md5': _md5(data_config_file)}
+
+    tasks = []
+    for group, files in file_dict.items():
+        num_blocks = max(1, min(num_workers, len(files)))
+        for block in np.array_split(np.arange(len(files)), num_blocks):
+            if len(block):
+                tasks.append((len(tasks), group, [files[i] for i in block]))
+
+    start = time.time()
+    shards = []
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(_convert_files, task, group, files, data_config, options, output_dir,
+                                       entries_per_shard, info) for task, group, files in tasks]
+            for fut in futures:
+                shards += fut.result()
+    else:
+        for task, group, files in tasks:
+            shards += _convert_files(task, group, files, data_config, options, output_dir, entries_per_shard, info)
+
+    manifest = dict(info, data_config=os.path.abspath(data_config_file),
+                    inputs={k: list(data_config.input_shapes[k][1:]) for k in data_config.input_names},
+                    labels=list(data_config.label_names), observers=list(data_config.z_variables),
+                    weight=data_config.weight_name if for_training else None,
+                    entries=sum(s['entries'] for s in shards), shards=shards,
+                    sources={group: files for group, files in file_dict.items()})
+    write_manifest(output_dir, manifest)
+    _logger.info('Converted %d files to %d shards (%d entries) in %.1f s, manifest written to %s',
+                 len(sum(file_dict.values(), [])), len(shards), manifest['entries'], time.time() - start,
+                 os.path.join(output_dir, MANIFEST_NAME))
+    return manifest
@@ -1,7 +1,9 @@
+import os
 import numpy as np
 import yaml
 import copy
 
+from itertools import chain
 from ..logger import _logger
 from .tools import _get_variable_names
 
@@ -15,18 +17,33 @@ def _as_list(x):
         return [x]
 
 
+# md5 checksums, keyed by (path, modification time, size)
+_md5_cache = {}
+
+
 def _md5(fname):
     '''https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file'''
-    import hashlib
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_mtime_ns, stat.st_size)
+    if key not in _md5_cache:
+        import hashlib
+        hash_md5 = hashlib.md5()
+        with open(fname, "rb") as f:
+            for chunk in iter(lambda: f.read(4096), b""):
+                hash_md5.update(chunk)
+        _md5_cache[key] = hash_md5.hexdigest()
+    return _md5_cache[key]
+
+
+# parsed and resolved DataConfig objects, keyed by (md5 of the YAML file, load_observers)
+_config_cache = {}
 
 
 class DataConfig(object):
     r"""Data loading configuration.
+
+    The objects returned by ``DataConfig.load`` (and by ``copy``) share their parsed state w/ a per-process cache,
+    so they must be treated as read-only: use ``copy(deep=True)`` to get an independent, modifiable one.
     """
 
     def __init__(self, print_info=True, **kwargs):
@@ -120,6 +137,7 @@ class DataConfig(object):
                 if self.reweight_hists is not None:
                     for k, v in self.reweight_hists.items():
                         self.reweight_hists[k] = np.array(v, dtype='float32')
+                self._stack_reweight_hists()
         # observers
         self.observer_names = tuple(opts['observers'])
         # monitor variables
@@ -184,27 +202,117 @@ class DataConfig(object):
         # keep and drop
         self.drop_branches = (aux_branches - self.keep_branches)
         self.load_branches = (aux_branches | self.keep_branches) - set(self.var_funcs.keys()) - {self.weight_name, }
+        # loaded branches feeding the inputs, the weights or the (non-simple) labels, directly or through `new_variables`:
+        # they are read as float32, while the other integer branches (e.g., event numbers in the selection) keep their dtype
+        self.float_branches = set()
+        queue = [n for names in self.input_dicts.values() for n in names] + [self.weight_name]
+        if self.label_type != 'simple':
+            queue += list(self.label_names)
+        while queue:
+            name = queue.pop()
+            if name is None or name in self.float_branches:
+                continue
+            self.float_branches.add(name)
+            if name in self.var_funcs:
+                queue += _get_variable_names(self.var_funcs[name])
+        self.float_branches &= self.load_branches
         if print_info:
             _logger.debug('drop_branches:\n  %s', ','.join(self.drop_branches))
             _logger.debug('load_branches:\n  %s', ','.join(self.load_branches))
+        # evaluation plans of the new variables, see `new_variables_plan`
+        self._plans = {}
+
+    def needed_branches(self, reweight=True):
+        r"""The branches (loaded or new) used after the new variables are built: the input variables, the labels (and the
+        label check), the observers/monitor variables, and the weights or the reweighting variables if ``reweight``."""
+        needed = set(chain(*self.input_dicts.values())) | set(self.label_names) | set(self.z_variables)
+        if self.label_type == 'simple':
+            needed.add('_labelcheck_')
+        if reweight and self.weight_name:
+            if self.use_precomputed_weights:
+                needed.add(self.weight_name)
+            else:
+                needed.update(self.reweight_branches)
+                needed.update(self.reweight_classes)
+        return frozenset(needed)
+
+    def new_variables_plan(self, targets):
+        r"""Evaluation steps ``(name, expr, drop)`` of only the new variables needed, directly or not, by ``targets``,
+        in topological order. ``drop`` lists the branches (loaded or new, not in ``targets``) whose last consumer is
+        this step, so that they can be released right after it."""
+        targets = frozenset(targets)
+        if targets in self._plans:
+            return self._plans[targets]
+        deps = {k: [n for n in _get_variable_names(expr) if n != k] for k, expr in self.var_funcs.items()}
+        order, visiting, done = [], set(), set()
+
+        def _visit(name):
+            if name in done or name not in self.var_funcs:
+                return
+            if name in visiting:
+                raise RuntimeError('Circular dependency in `new_variables` involving `%s`' % name)
+            visiting.add(name)
+            for n in deps[name]:
+                _visit(n)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.var_funcs:
+            if name in targets:
+                _visit(name)
+        last_consumer = {}
+        for i, name in enumerate(order):
+            for n in deps[name]:
+                last_consumer[n] = i
+        drops = [[] for _ in order]
+        for n, i in last_consumer.items():
+            if n not in targets:
+                drops[i].append(n)
+        plan = [(name, self.var_funcs[name], tuple(sorted(drops[i]))) for i, name in enumerate(order)]
+        self._plans[targets] = plan
+        return plan
 
     def __getattr__(self, name):
+        # no `options` yet, e.g., when unpickling (in the DataLoader workers)
+        if name.startswith('__') or 'options' not in self.__dict__:
+            raise AttributeError(name)
         return self.options[name]
 
     def dump(self, fp):
         with open(fp, 'w') as f:
             yaml.safe_dump(self.options, f, sort_keys=False)
 
+    def _stack_reweight_hists(self):
+        # the histograms of all the classes stacked as (classes, x bins, y bins), to look up the weights of all the
+        # entries at once w/ their class index, in the order of `reweight_hist_classes`
+        if self.reweight_hists is None:
+            self.reweight_hist_classes, self.reweight_hists_stacked = None, None
+        else:
+            self.reweight_hist_classes = tuple(self.reweight_hists.keys())
+            self.reweight_hists_stacked = np.stack([self.reweight_hists[k] for k in self.reweight_hist_classes])
+
     @classmethod
     def load(cls, fp, load_observers=True):
-        with open(fp) as f:
-            options = yaml.safe_load(f)
-        if not load_observers:
-            options['observers'] = None
-        return cls(**options)
-
-    def copy(self):
-        return self.__class__(print_info=False, **copy.deepcopy(self.options))
+        r"""Load the config from a YAML file. The file is parsed and the config resolved (i.e., the dependencies
+        between the branches analyzed) only once per process and content, and a cheap copy of it is returned."""
+        key = (_md5(fp), load_observers)
+        if key not in _config_cache:
+            with open(fp) as f:
+                # the C parser (if libyaml is available) is much faster for the large auto-generated files
+                options = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+            if not load_observers:
+                options['observers'] = None
+            _config_cache[key] = cls(**options)
+        return _config_cache[key].copy()
+
+    def copy(self, deep=False):
+        r"""Cheap copy, sharing the (read-only) parsed state; w/ ``deep``, an independent copy that can be modified."""
+        if deep:
+            return self.__class__(print_info=False, **copy.deepcopy(self.options))
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        return new
 
     def __copy__(self):
         return self.copy()
@@ -1,73 +1,343 @@
+import os
 import math
-import tqdm
+import numpy as np
+import threading
+import weakref
 import traceback
-from .tools import _concat
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures.thread import ThreadPoolExecutor
+from .tools import _concat, awkward
 from ..logger import _logger
+from ..lazy import LazyModule
+
+
+def _import_uproot3():
+    try:
+        import uproot3
+    except ImportError:
+        import uproot
+        if uproot.__version__[0] == '3':
+            uproot3 = uproot
+        else:
+            raise ImportError('Please install uproot3 with `pip install uproot3`.')
+    return uproot3
+
+
+# only imported when reading/writing ROOT files
+uproot3 = LazyModule('uproot3', _import_uproot3)
+
+
+# number of threads (per process) used to decompress HDF5 chunks (blosc) and to load the awkd branches in parallel
+_read_threads = 4
 
-try:
-    import uproot3
-except ImportError:
-    uproot3 = None
-    import uproot
-    if uproot.__version__[0] == '3':
-        uproot3 = uproot
-    else:
-        raise ImportError('Please install uproot3 with `pip install uproot3`.')
+
+def set_read_threads(num_threads):
+    global _read_threads
+    _read_threads = max(1, int(num_threads))
+
+
+def _entry_range(load_range, num_entries):
+    start = math.trunc(load_range[0] * num_entries)
+    stop = max(start + 1, math.trunc(load_range[1] * num_entries))
+    return start, stop
 
 
 def _read_hdf5(filepath, branches, load_range=None):
     import tables
-    tables.set_blosc_max_threads(4)
+    tables.set_blosc_max_threads(_read_threads)
     with tables.open_file(filepath) as f:
-        outputs = {k:getattr(f.root, k)[:] for k in branches}
-    if load_range is not None:
-        start = math.trunc(load_range[0] * len(outputs[branches[0]]))
-        stop = max(start + 1, math.trunc(load_range[1] * len(outputs[branches[0]])))
-        for k, v in outputs.items():
-            outputs[k] = v[start:stop]
+        nodes = {k: getattr(f.root, k) for k in branches}
+        num_entries = len(nodes[branches[0]])
+        start, stop = 0, num_entries
+        if load_range is not None:
+            # exactly the requested window: consecutive windows must partition the file w/o overlapping
+            start, stop = _entry_range(load_range, num_entries)
+        # libhdf5 is not thread-safe: the branches are read one by one, w/ the chunks decompressed by multiple blosc threads
+        outputs = {k: n.read(start, stop) for k, n in nodes.items()}
     return outputs
 
 
+class _ROOTFilePool(object):
+    r"""_ROOTFilePool.
+
+    LRU pool of open ROOT files (and their resolved trees), plus a bounded cache of decompressed baskets, so that
+    consecutive fetches of different ``load_range`` windows from the same file reuse the file handle, the metadata
+    and the baskets straddling the window boundaries. The pool is per process (i.e., per DataLoader worker).
+
+    Arguments:
+        max_files (int): maximum number of files kept open.
+        basket_cache_size (int): maximum size (in bytes) of the decompressed basket cache; no basket cache if 0.
+    """
+
+    def __init__(self, max_files=128, basket_cache_size=256 * 1024 ** 2):
+        self.max_files = max_files
+        self.basket_cache_size = basket_cache_size
+        self._lock = threading.Lock()
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # a new DataLoader worker: do not share the file handles (nor the lock) w/ the parent process
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self):
+        self._files = OrderedDict()
+        self._basket_cache = None
+        # files read in turn by each reader (e.g., data iterator) of this process, see `set_working_set`
+        self._working_sets = weakref.WeakKeyDictionary()
+        self.num_files = None
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    @property
+    def basket_cache(self):
+        if self._basket_cache is None and self.basket_cache_size > 0:
+            self._basket_cache = uproot3.cache.ThreadSafeArrayCache(self.basket_cache_size)
+        return self._basket_cache
+
+    @staticmethod
+    def _close(entry):
+        try:
+            entry['file'].__exit__(None, None, None)
+        except Exception:
+            pass
+
+    def set_working_set(self, owner, filelist):
+        r"""Register the files ``owner`` (e.g., a data iterator, until it is garbage collected) reads in turn, each
+        fetch walking through all of them w/ ``fetch_by_files=False``. If the files of all the owners in this process
+        do not fit into the pool together, the files are not kept open at all: an LRU cycling over more files than it
+        holds would miss on every access."""
+        with self._lock:
+            self._working_sets[owner] = frozenset(filelist)
+            self.num_files = len(frozenset().union(*self._working_sets.values()))
+
+    def clear(self):
+        with self._lock:
+            for entry in self._files.values():
+                self._close(entry)
+            self._files.clear()
+
+    @contextmanager
+    def tree(self, filepath, treename=None):
+        if self.num_files is not None and self.num_files > self.max_files:
+            with uproot3.open(filepath) as f:
+                yield f[_resolve_treename(f, filepath, treename)]
+            return
+        with self._lock:
+            entry = self._files.pop(filepath, None)
+            if entry is None:
+                entry = {'file': uproot3.open(filepath), 'trees': {}, 'lock': threading.Lock()}
+                while len(self._files) >= self.max_files:
+                    evicted = self._files.popitem(last=False)[1]
+                    with evicted['lock']:
+                        self._close(evicted)
+            self._files[filepath] = entry
+        with entry['lock']:
+            if treename not in entry['trees']:
+                entry['trees'][treename] = entry['file'][_resolve_treename(entry['file'], filepath, treename)]
+            yield entry['trees'][treename]
+
+
+def _resolve_treename(f, filepath, treename=None):
+    if treename is None:
+        treenames = set([k.decode('utf-8').split(';')[0] for k, v in f.allitems() if getattr(v, 'classname', '') == 'TTree'])
+        if len(treenames) == 1:
+            treename = treenames.pop()
+        else:
+            raise RuntimeError('Need to specify `treename` as more than one trees are found in file %s: %s' % (filepath, str(treenames)))
+    return treename
+
+
+_root_file_pool = _ROOTFilePool()
+
+
 def _read_root(filepath, branches, load_range=None, treename=None):
-    with uproot3.open(filepath) as f:
-        if treename is None:
-            treenames = set([k.decode('utf-8').split(';')[0] for k, v in f.allitems() if getattr(v, 'classname', '') == 'TTree'])
-            if len(treenames) == 1:
-                treename = treenames.pop()
-            else:
-                raise RuntimeError('Need to specify `treename` as more than one trees are found in file %s: %s' % (filepath, str(branches)))
-        tree = f[treename]
+    with _root_file_pool.tree(filepath, treename) as tree:
         if load_range is not None:
-            start = math.trunc(load_range[0] * tree.numentries)
-            stop = max(start + 1, math.trunc(load_range[1] * tree.numentries))
+            start, stop = _entry_range(load_range, tree.numentries)
         else:
             start, stop = None, None
-        outputs = tree.arrays(branches, namedecode='utf-8', entrystart=start, entrystop=stop)
+        outputs = tree.arrays(branches, namedecode='utf-8', entrystart=start, entrystop=stop,
+                              basketcache=_root_file_pool.basket_cache)
     return outputs
 
 
 def _read_awkd(filepath, branches, load_range=None):
     from .tools import awkward
     with awkward.load(filepath) as f:
-        outputs = {k: f[k] for k in branches}
+        # each branch is a separate (compressed) member of the zip archive: load them in parallel
+        if _read_threads > 1 and len(branches) > 1:
+            with ThreadPoolExecutor(max_workers=min(_read_threads, len(branches))) as executor:
+                outputs = dict(zip(branches, executor.map(f.__getitem__, branches)))
+        else:
+            outputs = {k: f[k] for k in branches}
     if load_range is not None:
-        start = math.trunc(load_range[0] * len(outputs[branches[0]]))
-        stop = max(start + 1, math.trunc(load_range[1] * len(outputs[branches[0]])))
+        start, stop = _entry_range(load_range, len(outputs[branches[0]]))
         for k, v in outputs.items():
             outputs[k] = v[start:stop]
     return outputs
 
 
-def _read_files(filelist, branches, load_range=None, show_progressbar=False, **kwargs):
-    import os
-    from collections import defaultdict
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('Please install pyarrow with `pip install pyarrow`.')
+    # the arrow threads decode the columns (and the row groups) in parallel
+    pyarrow.set_cpu_count(_read_threads)
+    return pyarrow
+
+
+def _arrow_to_numpy(column):
+    import pyarrow
+    if isinstance(column, pyarrow.ChunkedArray):
+        # no copy if the column is made of a single chunk (e.g., a single row group)
+        column = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+    if isinstance(column, (pyarrow.ListArray, pyarrow.LargeListArray)):
+        # the offsets of a sliced list array point into the unsliced values, so this does not copy either
+        offsets = column.offsets.to_numpy()
+        content = _arrow_to_numpy(column.values)
+        return awkward.JaggedArray.fromoffsets(offsets, content)
+    return column.to_numpy(zero_copy_only=False)
+
+
+def _row_group_fails(row_group, columns, cuts):
+    # the statistics are only usable for flat (non-list) columns
+    for name, op, value in cuts:
+        if name not in columns:
+            continue
+        stats = row_group.column(columns[name]).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        lo, hi = stats.min, stats.max
+        if (op == '<' and lo >= value) or (op == '<=' and lo > value) or (op == '>' and hi <= value) or \
+                (op == '>=' and hi < value) or (op == '==' and (value < lo or value > hi)):
+            return True
+    return False
+
+
+def _read_parquet(filepath, branches, load_range=None, selection=None):
+    r"""Returns the table, and the number of entries (in ``load_range``) skipped w/o reading them, as no entry in their
+    row groups can pass the ``selection``."""
+    _import_pyarrow()
+    import pyarrow.types
+    import pyarrow.parquet as pq
+    from .tools import _get_selection_cuts
+    f = pq.ParquetFile(filepath, memory_map=True)
+    meta = f.metadata
+    num_entries = meta.num_rows
+    start, stop = 0, num_entries
+    if load_range is not None:
+        start, stop = _entry_range(load_range, num_entries)
+
+    # map the entry range to the row groups
+    row_groups, group_start = [], 0
+    for i in range(meta.num_row_groups):
+        group_stop = group_start + meta.row_group(i).num_rows
+        if group_stop > start and group_start < stop:
+            row_groups.append((i, group_start, group_stop))
+        group_start = group_stop
+
+    # skip the row groups in which no entry can pass the selection, according to the min/max statistics
+    cuts = _get_selection_cuts(selection)
+    num_requested = sum(min(rg[2], stop) - max(rg[1], start) for rg in row_groups)
+    if cuts and row_groups:
+        schema = f.schema_arrow
+        flat_columns = {}
+        rg0 = meta.row_group(0)
+        for j in range(rg0.num_columns):
+            path = rg0.column(j).path_in_schema
+            idx = schema.get_field_index(path)
+            if idx >= 0 and not pyarrow.types.is_nested(schema.field(idx).type):
+                flat_columns[path] = j
+        row_groups = [rg for rg in row_groups if not _row_group_fails(meta.row_group(rg[0]), flat_columns, cuts)]
+
+    if row_groups:
+        table = f.read_row_groups([rg[0] for rg in row_groups], columns=branches, use_threads=_read_threads > 1)
+        # trim to the entry range the partially covered first/last row groups
+        offset = max(0, start - row_groups[0][1])
+        length = sum(rg[2] - rg[1] for rg in row_groups) - offset - max(0, row_groups[-1][2] - stop)
+        if offset > 0 or length < table.num_rows:
+            table = table.slice(offset, length)
+    else:
+        table = f.schema_arrow.empty_table().select(branches)
+    return {k: _arrow_to_numpy(table.column(k)) for k in branches}, num_requested - table.num_rows
+
+
+def _read_arrow(filepath, branches, load_range=None):
+    _import_pyarrow()
+    import pyarrow.feather as feather
+    table = feather.read_table(filepath, columns=branches, memory_map=True, use_threads=_read_threads > 1)
+    if load_range is not None:
+        start, stop = _entry_range(load_range, table.num_rows)
+        table = table.slice(start, stop - start)
+    return {k: _arrow_to_numpy(table.column(k)) for k in branches}
+
+
+def _output_dtype(a, name, float_branches):
+    # integer (and boolean) branches keep their dtype, unless they feed the inputs (or no exception is given)
+    if isinstance(a, np.ndarray):
+        # checked first: flat arrays never touch `awkward`, so its lazy import is only paid for the jagged ones
+        dtype = a.dtype
+    elif isinstance(a, awkward.JaggedArray):
+        dtype = getattr(a.content, 'dtype', None)
+    else:
+        dtype = getattr(a, 'dtype', None)
+    if dtype is not None and dtype.kind in 'biu' and float_branches is not None and name not in float_branches:
+        return dtype
+    return np.dtype('float32')
+
+
+def _merge_branch(arrs, dtype):
+    r"""Merge the arrays of one branch read from several files into a single array of ``dtype``, copying the data
+    only once: straight into a buffer preallocated from the entry counts, or not at all if there is a single array
+    already of the right dtype."""
+    if len(arrs) == 1:
+        a = arrs[0]
+        if isinstance(a, np.ndarray):
+            return a.astype(dtype, copy=False)
+        if isinstance(a, awkward.JaggedArray) and isinstance(a.content, np.ndarray) and a.content.dtype == dtype:
+            return a
+    if all(isinstance(a, np.ndarray) for a in arrs):
+        out = np.empty((sum(len(a) for a in arrs),) + arrs[0].shape[1:], dtype=dtype)
+        pos = 0
+        for a in arrs:
+            out[pos:pos + len(a)] = a
+            pos += len(a)
+        return out
+    if all(isinstance(a, awkward.JaggedArray) and isinstance(a.content, np.ndarray) for a in arrs):
+        counts = np.empty(sum(len(a) for a in arrs), dtype='int64')
+        content = np.empty((sum(int(a.counts.sum()) for a in arrs),) + arrs[0].content.shape[1:], dtype=dtype)
+        pos, cpos = 0, 0
+        for a in arrs:
+            counts[pos:pos + len(a)] = a.counts
+            flat = a.flatten()
+            content[cpos:cpos + len(flat)] = flat
+            pos += len(a)
+            cpos += len(flat)
+        return awkward.JaggedArray.fromcounts(counts, content)
+    # e.g., doubly jagged arrays
+    return _concat([a.astype(dtype) for a in arrs])
+
+
+def _read_files(filelist, branches, load_range=None, show_progressbar=False, float_branches=None, **kwargs):
+    r"""Read ``branches`` from ``filelist`` into a table.
+
+    The branches are converted to float32, except for the integer (and boolean) branches not in ``float_branches``
+    (e.g., event numbers used in selections), which keep their dtype. All the branches are converted if
+    ``float_branches`` is ``None``.
+    """
     branches = list(branches)
-    table = defaultdict(list)
+    outputs = []
+    # entries skipped by the readers as they cannot pass the selection
+    num_skipped = 0
     if show_progressbar:
+        import tqdm
         filelist = tqdm.tqdm(filelist)
     for filepath in filelist:
         ext = os.path.splitext(filepath)[1]
-        if ext not in ('.h5', '.root', '.awkd'):
+        if ext not in ('.h5', '.root', '.awkd', '.parquet', '.arrow', '.feather'):
             raise RuntimeError('File %s of type `%s` is not supported!' % (filepath, ext))
         try:
             if ext == '.h5':
@@ -76,24 +346,44 @@ def _read_files(filelist, branches, load_range=None, show_progressbar=False, **k
                 a = _read_root(filepath, branches, load_range=load_range, treename=kwargs.get('treename', None))
             elif ext == '.awkd':
                 a = _read_awkd(filepath, branches, load_range=load_range)
+            elif ext == '.parquet':
+                a, skipped = _read_parquet(filepath, branches, load_range=load_range,
+                                           selection=kwargs.get('selection', None))
+                num_skipped += skipped
+            elif ext in ('.arrow', '.feather'):
+                a = _read_arrow(filepath, branches, load_range=load_range)
         except Exception as e:
             a = None
             _logger.error('When reading file %s:', filepath)
             _logger.error(traceback.format_exc())
         if a is not None:
-            for name in branches:
-                table[name].append(a[name].astype('float32'))
-    table = {name:_concat(arrs) for name, arrs in table.items()}
-    if len(table[branches[0]]) == 0:
+            outputs.append(a)
+    if sum(len(a[branches[0]]) for a in outputs) == 0 and num_skipped == 0:
+        # (an empty table is fine if all the entries were skipped, e.g., w/ the files sorted by a variable cut on)
         raise RuntimeError(f'Zero entries loaded when reading files {filelist} with `load_range`={load_range}.')
+    table = {}
+    for name in branches:
+        # release the arrays read from the files as soon as the branch is merged, to keep the peak memory low
+        arrs = [a.pop(name) for a in outputs]
+        table[name] = _merge_branch(arrs, _output_dtype(arrs[0], name, float_branches))
+        del arrs
     return table
 
 
 def _write_root(file, table, treename='Events', compression=-1, step=1048576):
     if compression == -1:
         compression = uproot3.write.compress.LZ4(4)
+    # jagged arrays are written w/ an additional counts branch `n<name>`
+    branches, table = {}, dict(table)
+    for k, v in list(table.items()):
+        if isinstance(v, awkward.JaggedArray):
+            table['n' + k] = v.counts.astype('int32')
+            branches['n' + k] = table['n' + k].dtype
+            branches[k] = uproot3.newbranch(v.content.dtype, size='n' + k)
+        else:
+            branches[k] = v.dtype
     with uproot3.recreate(file, compression=compression) as fout:
-        fout[treename] = uproot3.newtree({k:v.dtype for k, v in table.items()})
+        fout[treename] = uproot3.newtree(branches)
         start = 0
         while start < len(list(table.values())[0]) - 1:
             fout[treename].extend({k:v[start:start + step] for k, v in table.items()})
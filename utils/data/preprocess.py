@@ -18,17 +18,22 @@ def _apply_selection(table, selection):
 
 
 def _build_new_variables(table, funcs):
+    r"""Evaluate the new variables: ``funcs`` is either a dict ``{name: expr}``, evaluated in order, or a plan from
+    ``DataConfig.new_variables_plan``, also releasing the branches no longer needed."""
     if funcs is None:
         return
-    for k, expr in funcs.items():
-        if k in table:
-            continue
-        table[k] = _eval_expr(expr, table)
+    steps = [(k, expr, ()) for k, expr in funcs.items()] if isinstance(funcs, dict) else funcs
+    for k, expr, drop in steps:
+        if k not in table:
+            table[k] = _eval_expr(expr, table)
+        for n in drop:
+            table.pop(n, None)
 
 
 def _clean_up(table, drop_branches):
     for k in drop_branches:
-        del table[k]
+        # (may have been released already after building the new variables)
+        table.pop(k, None)
 
 
 class AutoStandardizer(object):
@@ -46,7 +51,8 @@ class AutoStandardizer(object):
             filelist = sum(filelist.values(), [])
         self._filelist = filelist if isinstance(
             filelist, (list, tuple)) else glob.glob(filelist)
-        self._data_config = data_config.copy()
+        # modified in place w/ the produced info
+        self._data_config = data_config.copy(deep=True)
         self.load_range = (0, data_config.preprocess.get('data_fraction', 0.1))
 
     def read_file(self, filelist):
@@ -64,8 +70,9 @@ class AutoStandardizer(object):
             self.load_branches.update(_get_variable_names(self._data_config.selection))
         _logger.debug('[AutoStandardizer] keep_branches:\n  %s', ','.join(self.keep_branches))
         _logger.debug('[AutoStandardizer] load_branches:\n  %s', ','.join(self.load_branches))
-        table = _read_files(filelist, self.load_branches, self.load_range,
-                            show_progressbar=True, treename=self._data_config.treename)
+        table = _read_files(filelist, self.load_branches, self.load_range, show_progressbar=True,
+                            treename=self._data_config.treename, selection=self._data_config.selection,
+                            float_branches=self._data_config.float_branches)
         _apply_selection(table, self._data_config.selection)
         _build_new_variables(table, {k: v for k, v in self._data_config.var_funcs.items() if k in self.keep_branches})
         _clean_up(table, self.load_branches - self.keep_branches)
@@ -120,7 +127,8 @@ class WeightMaker(object):
         if isinstance(filelist, dict):
             filelist = sum(filelist.values(), [])
         self._filelist = filelist if isinstance(filelist, (list, tuple)) else glob.glob(filelist)
-        self._data_config = data_config.copy()
+        # modified in place w/ the produced info
+        self._data_config = data_config.copy(deep=True)
 
     def read_file(self, filelist):
         self.keep_branches = set(self._data_config.reweight_branches + self._data_config.reweight_classes)
@@ -135,7 +143,8 @@ class WeightMaker(object):
             self.load_branches.update(_get_variable_names(self._data_config.selection))
         _logger.debug('[WeightMaker] keep_branches:\n  %s', ','.join(self.keep_branches))
         _logger.debug('[WeightMaker] load_branches:\n  %s', ','.join(self.load_branches))
-        table = _read_files(filelist, self.load_branches, show_progressbar=True, treename=self._data_config.treename)
+        table = _read_files(filelist, self.load_branches, show_progressbar=True, treename=self._data_config.treename,
+                            selection=self._data_config.selection, float_branches=self._data_config.float_branches)
         _apply_selection(table, self._data_config.selection)
         _build_new_variables(table, {k: v for k, v in self._data_config.var_funcs.items() if k in self.keep_branches})
         _clean_up(table, self.load_branches - self.keep_branches)
@@ -223,6 +232,7 @@ class WeightMaker(object):
         table = self.read_file(self._filelist)
         wgts = self.make_weights(table)
         self._data_config.reweight_hists = wgts
+        self._data_config._stack_reweight_hists()
         # must also propogate the changes to `data_config.options` so it can be persisted
         self._data_config.options['weights']['reweight_hists'] = {k: v.tolist() for k, v in wgts.items()}
         if output:
@@ -0,0 +1,70 @@
+import os
+import json
+import numpy as np
+
+from .fileio import _read_files
+
+SHARD_FORMAT = 'weaver-shard'
+SHARD_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+# the stacked inputs are stored as `inputs__<name>` (`_<name>` in the table): PyTables reserves some `_x_` prefixes
+INPUT_PREFIX = 'inputs__'
+
+
+def shard_branches(data_config, with_weights=True):
+    r"""Mapping from the arrays stored in the shards to the names in the (preprocessed) table."""
+    branches = {INPUT_PREFIX + k: '_' + k for k in data_config.input_names}
+    for k in list(data_config.label_names) + list(data_config.z_variables):
+        branches[k] = k
+    if with_weights and data_config.weight_name is not None:
+        branches[data_config.weight_name] = data_config.weight_name
+    return branches
+
+
+def write_shard(filepath, table, data_config, info, chunk_bytes=1024 ** 2, complevel=5):
+    r"""Write a preprocessed table to a shard: one fixed-shape array per input group/label/weight/observer,
+    compressed in chunks of about ``chunk_bytes``, w/ ``info`` stored in the attributes of the root node."""
+    import tables
+    filters = tables.Filters(complevel=complevel, complib='blosc:lz4', shuffle=True)
+    with tables.open_file(filepath, mode='w') as f:
+        for key, name in shard_branches(data_config).items():
+            if name not in table:
+                continue
+            a = table[name]
+            if not isinstance(a, np.ndarray):
+                raise ValueError('Cannot store the jagged array `%s` in a shard: only fixed-shape arrays are supported '
+                                 '(e.g., observe a padded version of it, defined in `new_variables` w/ `_pad`)' % name)
+            # chunks sized for sequential streaming, along the entry axis
+            row_bytes = max(1, a.itemsize * int(np.prod(a.shape[1:])))
+            chunkshape = (max(1, min(len(a), chunk_bytes // row_bytes)),) + a.shape[1:]
+            f.create_carray(f.root, key, obj=a, filters=filters, chunkshape=chunkshape)
+        f.root._v_attrs.weaver_shard = json.dumps(dict(info, format=SHARD_FORMAT, version=SHARD_VERSION))
+
+
+def shard_info(filepath):
+    r"""The info stored in a shard, or ``None`` if ``filepath`` is not a shard."""
+    if os.path.splitext(filepath)[1] != '.h5':
+        return None
+    import tables
+    with tables.open_file(filepath) as f:
+        info = getattr(f.root._v_attrs, 'weaver_shard', None)
+    if info is None:
+        return None
+    info = json.loads(info)
+    if info.get('format') != SHARD_FORMAT or info.get('version') != SHARD_VERSION:
+        raise RuntimeError('Unsupported shard format in file %s: %s' % (filepath, info))
+    return info
+
+
+def read_shards(filelist, data_config, load_range=None, with_weights=False):
+    r"""Read the preprocessed table from a list of shards."""
+    branches = shard_branches(data_config, with_weights=with_weights)
+    # the labels and the observers keep their dtype
+    table = _read_files(filelist, branches.keys(), load_range,
+                        float_branches={k for k in branches if k.startswith(INPUT_PREFIX) or k == data_config.weight_name})
+    return {branches[k]: v for k, v in table.items()}
+
+
+def write_manifest(output_dir, manifest):
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
@@ -0,0 +1,78 @@
+import os
+import json
+import atexit
+import shutil
+import numpy as np
+
+
+def _shm_dir():
+    return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class SharedTable(object):
+    r"""SharedTable.
+
+    A (preprocessed) table held in shared memory: each array is written to a ``.npy`` file in ``/dev/shm`` and
+    memory-mapped read-only by every process using it, so all the DataLoader workers and DDP ranks on a node share
+    a single copy. The files are removed by ``unlink``, once every process has attached, or else when the creating
+    process exits; the existing mappings stay valid either way.
+
+    Arguments:
+        path (str): directory holding the arrays, as passed to ``SharedTable.create``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._unlinked = False
+        self._attach()
+
+    def _attach(self):
+        with open(os.path.join(self.path, 'table.json')) as f:
+            self.keys = json.load(f)['keys']
+        self.table = {k: np.load(os.path.join(self.path, k + '.npy'), mmap_mode='r') for k in self.keys}
+
+    @classmethod
+    def create(cls, path, table):
+        os.makedirs(path, exist_ok=True)
+        atexit.register(shutil.rmtree, path, ignore_errors=True)
+        for k, v in table.items():
+            if not isinstance(v, np.ndarray):
+                raise ValueError('Cannot share the jagged array `%s`: only fixed-shape arrays are supported' % k)
+            np.save(os.path.join(path, k + '.npy'), v)
+        # written last: marks the table as complete
+        with open(os.path.join(path, 'table.json'), 'w') as f:
+            json.dump({'keys': list(table.keys())}, f)
+        return cls(path)
+
+    def unlink(self):
+        r"""Remove the files right away, e.g., so that they do not outlive a killed run. The existing mappings, and the
+        ones inherited by forked processes, stay valid, but the table can no longer be attached (or pickled) by path."""
+        shutil.rmtree(self.path, ignore_errors=True)
+        self._unlinked = True
+
+    @staticmethod
+    def default_path(key):
+        import tempfile
+        return os.path.join(_shm_dir() or tempfile.gettempdir(), 'weaver_shared_%s' % key)
+
+    def __len__(self):
+        return len(self.table[self.keys[0]]) if self.keys else 0
+
+    @property
+    def nbytes(self):
+        return sum(v.nbytes for v in self.table.values())
+
+    def __getstate__(self):
+        # re-attached by path, e.g., in DataLoader workers started w/ `spawn`
+        if self._unlinked:
+            raise RuntimeError('Cannot pickle the shared table at %s: its files are already removed' % self.path)
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._unlinked = False
+        self._attach()
+
+    def __deepcopy__(self, memo):
+        # the arrays must stay shared w/ all the copies of the dataset
+        return self
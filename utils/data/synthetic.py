@@ -0,0 +1,137 @@
+import os
+import numpy as np
+
+from ..logger import _logger
+from .tools import awkward, _pad, _get_selection_cuts
+
+SYNTHETIC_FORMATS = ('root', 'h5', 'awkd')
+
+
+def _selection_bounds(expr, bounds):
+    r"""Collect the ``var <op> constant`` comparisons of a selection expression into ``bounds``:
+    ``{var: {'min': ..., 'max': ..., 'values': set(...)}}``. Other terms are ignored.
+    """
+    for var, op, value in _get_selection_cuts(expr, any_level=True):
+        b = bounds.setdefault(var, {'min': None, 'max': None, 'values': set()})
+        if op in ('>', '>='):
+            b['min'] = value if b['min'] is None else min(b['min'], value)
+        elif op in ('<', '<='):
+            b['max'] = value if b['max'] is None else max(b['max'], value)
+        else:
+            b['values'].add(value)
+    return bounds
+
+
+def _collection_lengths(data_config):
+    r"""Object collections (e.g., ``pfcand``, ``sv``) are identified by the name prefix of the padded input variables."""
+    lengths = {}
+    for k, params in data_config.preprocess_params.items():
+        if params['length'] is not None:
+            prefix = k.split('_')[0]
+            lengths[prefix] = max(lengths.get(prefix, 0), params['length'])
+    return lengths
+
+
+def _sample_values(rng, name, size, bounds, params):
+    b = bounds.get(name)
+    if b is not None and b['values'] and b['min'] is None and b['max'] is None:
+        return rng.choice(sorted(b['values']), size=size).astype('float32')
+    if b is not None and (b['min'] is not None or b['max'] is not None):
+        lo, hi = b['min'], b['max']
+        if lo is None:
+            lo = hi - max(1, abs(hi))
+        if hi is None:
+            hi = lo + max(1, abs(lo))
+        # extend the range by 10% on both sides, so the selection actually rejects some entries
+        margin = 0.1 * (hi - lo)
+        return rng.uniform(lo - margin, hi + margin, size=size).astype('float32')
+    center, scale = 0, 1
+    if params is not None:
+        if isinstance(params['center'], (int, float)):
+            center = params['center']
+        if params['scale']:
+            scale = params['scale']
+    # standardized inputs (i.e., `(x - center) * scale`) follow N(0, 1)
+    return rng.normal(center, 1. / scale, size=size).astype('float32')
+
+
+def make_synthetic_table(data_config, num_entries, multiplicity=0.4, dispersion=5, seed=None):
+    r"""Generate a table w/ all the branches needed by ``data_config``.
+
+    Branches of the object collections (sharing the name prefix of a padded input, e.g., ``pfcand_*``) are jagged,
+    w/ the multiplicity following a negative binomial distribution w/ a mean of ``multiplicity`` times the padding
+    length and shape parameter ``dispersion`` (so a fraction of the entries overflows the padding length).
+    Variables constrained by the selection or the reweighting are sampled within the accepted range, simple labels
+    are one-hot, and the input variables are sampled from N(center, 1/scale) of their standardization parameters.
+
+    Returns:
+        table (dict), lengths (dict): the table and the padding length of each object collection.
+    """
+    rng = np.random.default_rng(seed)
+    bounds = {}
+    _selection_bounds(data_config.selection, bounds)
+    _selection_bounds(data_config.test_time_selection, bounds)
+    if data_config.weight_name and not data_config.use_precomputed_weights:
+        for name, bins in zip(data_config.reweight_branches, data_config.reweight_bins):
+            bounds[name] = {'min': min(bins), 'max': max(bins), 'values': set()}
+        for name in data_config.reweight_classes:
+            bounds.setdefault(name, {'min': None, 'max': None, 'values': {0, 1}})
+
+    lengths = _collection_lengths(data_config)
+    counts = {}
+    for prefix, length in lengths.items():
+        mean = max(1e-3, multiplicity * length)
+        counts[prefix] = rng.negative_binomial(dispersion, dispersion / (dispersion + mean), size=num_entries)
+
+    label_names = data_config.label_value if data_config.label_type == 'simple' else []
+    labels = rng.integers(len(label_names), size=num_entries) if label_names else None
+
+    table = {}
+    for name in sorted(data_config.load_branches):
+        if name in label_names:
+            table[name] = (labels == label_names.index(name)).astype('float32')
+            continue
+        prefix = name.split('_')[0]
+        params = data_config.preprocess_params.get(name)
+        if prefix in counts:
+            content = _sample_values(rng, name, counts[prefix].sum(), bounds, params)
+            table[name] = awkward.JaggedArray.fromcounts(counts[prefix], content)
+        else:
+            table[name] = _sample_values(rng, name, num_entries, bounds, params)
+    return table, lengths
+
+
+def _write_hdf5(filepath, table, lengths):
+    import tables
+    filters = tables.Filters(complevel=5, complib='blosc:lz4')
+    with tables.open_file(filepath, mode='w') as f:
+        for k, v in table.items():
+            if isinstance(v, awkward.JaggedArray):
+                # HDF5 files hold regular arrays only: store the jagged branches padded
+                v = _pad(v, lengths[k.split('_')[0]])
+            f.create_carray(f.root, k, obj=v, filters=filters)
+
+
+def write_synthetic_files(data_config, output_dir, fmt='root', num_files=4, entries_per_file=10000, seed=42,
+                          **kwargs):
+    r"""Write ``num_files`` synthetic files of format ``fmt`` (``root``, ``h5`` or ``awkd``) to ``output_dir``.
+
+    Returns the list of file paths.
+    """
+    if fmt not in SYNTHETIC_FORMATS:
+        raise ValueError('Invalid synthetic file format: %s' % fmt)
+    os.makedirs(output_dir, exist_ok=True)
+    filelist = []
+    for i in range(num_files):
+        table, lengths = make_synthetic_table(data_config, entries_per_file, seed=seed + i, **kwargs)
+        filepath = os.path.join(output_dir, 'synthetic_%d.%s' % (i, fmt))
+        if fmt == 'root':
+            from .fileio import _write_root
+            _write_root(filepath, table, treename=data_config.treename or 'Events')
+        elif fmt == 'h5':
+            _write_hdf5(filepath, table, lengths)
+        else:
+            awkward.save(filepath, table, mode='w')
+        filelist.append(filepath)
+    _logger.info('Written %d synthetic %s files (%d entries each) to %s', num_files, fmt, entries_per_file, output_dir)
+    return filelist
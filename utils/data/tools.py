@@ -1,12 +1,22 @@
 import numpy as np
 import math
+import functools
 
-try:
-    import awkward0 as awkward
-except ImportError:
-    import awkward
-    if awkward.__version__[0] == '1':
-        raise ImportError('Please install awkward0 with `pip install awkward0`.')
+from ..lazy import LazyModule
+
+
+def _import_awkward():
+    try:
+        import awkward0 as awkward
+    except ImportError:
+        import awkward
+        if awkward.__version__[0] == '1':
+            raise ImportError('Please install awkward0 with `pip install awkward0`.')
+    return awkward
+
+
+# only imported when actually used (i.e., for jagged arrays)
+awkward = LazyModule('awkward0', _import_awkward)
 
 
 def _concat(arrays, axis=0):
@@ -111,11 +121,63 @@ def _p4_from_ptetaphie(*args):
     return TLorentzVectorArray.from_ptetaphie(*args)
 
 
-def _get_variable_names(expr, exclude=['awkward', 'np', 'numpy', 'math']):
+@functools.lru_cache(maxsize=None)
+def _parse_variable_names(expr, exclude):
     import ast
     root = ast.parse(expr)
-    return sorted({node.id for node in ast.walk(root) if isinstance(
-        node, ast.Name) and not node.id.startswith('_')} - set(exclude))
+    return tuple(sorted({node.id for node in ast.walk(root) if isinstance(
+        node, ast.Name) and not node.id.startswith('_')} - set(exclude)))
+
+
+def _get_variable_names(expr, exclude=['awkward', 'np', 'numpy', 'math']):
+    return list(_parse_variable_names(expr, tuple(exclude)))
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_expr(expr):
+    # code objects cannot be pickled: compiled once per process
+    return compile(expr, '<%s>' % expr, 'eval')
+
+
+def _get_selection_cuts(expr, any_level=False):
+    r"""The ``var <op> constant`` comparisons in the top-level conjunction (``&`` or ``and``) of a selection, as a list
+    of ``(var, op, value)`` w/ ``op`` in ``<, <=, >, >=, ==``. Every entry passing the selection passes all of them.
+    If ``any_level``, the comparisons nested in any other expression (e.g., under ``|``) are also included."""
+    import ast
+    ops = {ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=', ast.Eq: '=='}
+    flipped = {'<': '>', '<=': '>=', '>': '<', '>=': '<=', '==': '=='}
+
+    def _constant(node):
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            value = _constant(node.operand)
+            return None if value is None else (-value if isinstance(node.op, ast.USub) else value)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return node.value
+        return None
+
+    cuts = []
+
+    def _visit(node):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitAnd):
+            _visit(node.left)
+            _visit(node.right)
+        elif isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+            for v in node.values:
+                _visit(v)
+        elif isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in ops:
+            left, op, right = node.left, ops[type(node.ops[0])], node.comparators[0]
+            if not isinstance(left, ast.Name):
+                left, op, right = right, flipped[op], left
+            value = _constant(right)
+            if isinstance(left, ast.Name) and value is not None:
+                cuts.append((left.id, op, value))
+        elif any_level:
+            for child in ast.iter_child_nodes(node):
+                _visit(child)
+
+    if expr:
+        _visit(ast.parse(expr, mode='eval').body)
+    return cuts
 
 
 def _eval_expr(expr, table):
@@ -125,4 +187,4 @@ def _eval_expr(expr, table):
          '_repeat_pad': _repeat_pad, '_clip': _clip, '_batch_knn': _batch_knn,
          '_batch_permute_indices': _batch_permute_indices, '_batch_argsort': _batch_argsort,
          '_batch_gather': _batch_gather, '_p4_from_xyzt': _p4_from_xyzt, '_p4_from_ptetaphie': _p4_from_ptetaphie})
-    return eval(expr, tmp)
+    return eval(_compile_expr(expr), tmp)
@@ -1,42 +1,52 @@
 import os
+import time
 import copy
 import json
+import hashlib
+import multiprocessing
 import numpy as np
 import torch.utils.data
 
 from itertools import chain
 from functools import partial
+from contextlib import nullcontext
 from concurrent.futures.thread import ThreadPoolExecutor
 from .logger import _logger, warn_once
+from .timer import StageTimer
+from .memory import MemoryMonitor, current_rss, table_nbytes
 from .data.tools import _pad, _repeat_pad, _clip
-from .data.fileio import _read_files
+from .data.fileio import _read_files, _root_file_pool
+from .data.shards import shard_info, shard_branches, read_shards
+from .data.shared import SharedTable
 from .data.config import DataConfig, _md5
 from .data.preprocess import _apply_selection, _build_new_variables, _clean_up, AutoStandardizer, WeightMaker
 
+# auto mode of `fetch_step`: minimum number of entries (passing the selection) per fetch, for the shuffling and
+# sampling to be effective; and memory budget (in GB) of the preprocessed tables per worker (current + prefetched),
+# if `memory_soft_limit` is not set
+_AUTO_FETCH_MIN_ENTRIES = 10000
+_AUTO_FETCH_MEMORY_BUDGET = 1.
+
 
 def _build_weights(table, data_config):
     if data_config.weight_name and not data_config.use_precomputed_weights:
         x_var, y_var = data_config.reweight_branches
         x_bins, y_bins = data_config.reweight_bins
-        rwgt_sel = None
+        # single pass over the entries: look up the weights in the stacked (classes, x bins, y bins) histograms
+        # w/ the class index (the classes are one-hot) and the x/y bin indices of each entry
+        classes, hists = data_config.reweight_hist_classes, data_config.reweight_hists_stacked
+        onehot = np.stack([table[label] for label in classes], axis=1) == 1
+        class_indices = onehot.argmax(axis=1)
+        pos = onehot[np.arange(len(class_indices)), class_indices]
+        del onehot
         if data_config.reweight_discard_under_overflow:
-            rwgt_sel = (table[x_var] >= min(x_bins)) & (table[x_var] <= max(x_bins)) & \
+            pos &= (table[x_var] >= min(x_bins)) & (table[x_var] <= max(x_bins)) & \
                 (table[y_var] >= min(y_bins)) & (table[y_var] <= max(y_bins))
-        # init w/ wgt=0: events not belonging to any class in `reweight_classes` will get a weight of 0 at the end
-        wgt = np.zeros(len(table[x_var]), dtype='float32')
-        sum_evts = 0
-        for label, hist in data_config.reweight_hists.items():
-            pos = table[label] == 1
-            if rwgt_sel is not None:
-                pos &= rwgt_sel
-            rwgt_x_vals = table[x_var][pos]
-            rwgt_y_vals = table[y_var][pos]
-            x_indices = np.clip(np.digitize(
-                rwgt_x_vals, x_bins) - 1, a_min=0, a_max=len(x_bins) - 2)
-            y_indices = np.clip(np.digitize(
-                rwgt_y_vals, y_bins) - 1, a_min=0, a_max=len(y_bins) - 2)
-            wgt[pos] = hist[x_indices, y_indices]
-            sum_evts += pos.sum()
+        x_indices = np.clip(np.digitize(table[x_var], x_bins) - 1, a_min=0, a_max=len(x_bins) - 2)
+        y_indices = np.clip(np.digitize(table[y_var], y_bins) - 1, a_min=0, a_max=len(y_bins) - 2)
+        # events not belonging to any class in `reweight_classes` (or discarded) get a weight of 0
+        wgt = np.where(pos, hists[class_indices, x_indices, y_indices], 0).astype('float32', copy=False)
+        sum_evts = pos.sum()
         if sum_evts != len(table[x_var]):
             warn_once(
                 'Not all selected events used in the reweighting. '
@@ -72,20 +82,21 @@ def _finalize_inputs(table, data_config):
             del table[n]
 
 
-def _get_reweight_indices(weights, up_sample=True, max_resample=10, weight_scale=1):
-    all_indices = np.arange(len(weights))
-    randwgt = np.random.uniform(low=0, high=weight_scale, size=len(weights))
-    keep_flags = randwgt < weights
+def _get_reweight_indices(weights, up_sample=True, max_resample=10, weight_scale=1, rng=None):
+    r"""Sample the entries to keep w/ a probability ``weights / weight_scale``.
+
+    W/ ``up_sample``, each entry is given ``n_repeats`` chances (the inverse of the expected fraction of entries kept,
+    at most ``max_resample``), i.e., it is kept a binomially distributed number of times. The keep-counts are drawn
+    directly, so only O(N) memory is used. ``rng`` (a ``numpy.random.Generator``) defaults to ``numpy.random``.
+    """
+    if rng is None:
+        rng = np.random
     if not up_sample:
-        keep_indices = all_indices[keep_flags]
-    else:
-        n_repeats = len(weights) // max(1, int(keep_flags.sum()))
-        if n_repeats > max_resample:
-            n_repeats = max_resample
-        all_indices = np.repeat(np.arange(len(weights)), n_repeats)
-        randwgt = np.random.uniform(low=0, high=weight_scale, size=len(weights) * n_repeats)
-        keep_indices = all_indices[randwgt < np.repeat(weights, n_repeats)]
-    return keep_indices.copy()
+        return np.nonzero(rng.uniform(low=0, high=weight_scale, size=len(weights)) < weights)[0]
+    prob = np.clip(np.asarray(weights, dtype='float64') / weight_scale, 0, 1)
+    n_repeats = min(max_resample, len(weights) // max(1, int(round(prob.sum()))))
+    counts = rng.binomial(max(1, n_repeats), prob)
+    return np.repeat(np.arange(len(weights)), counts)
 
 
 def _check_labels(table):
@@ -98,39 +109,96 @@ def _check_labels(table):
             raise RuntimeError('Inconsistent label definition: some of the entries are assigned to multiple classes!')
 
 
-def _preprocess(table, data_config, options):
+def _transform(table, data_config, options, timer=None):
+    r"""Everything but the sampling: returns the number of entries passing the selection."""
+    def _time(stage):
+        return timer.time(stage, entries=_num_entries(table)) if timer is not None else nullcontext()
+
+    if _num_entries(table) == 0:
+        # e.g., all the entries skipped by the reader as they cannot pass the selection
+        return 0
     # apply selection
-    entries = _apply_selection(table, data_config.selection if options['training'] else data_config.test_time_selection)
+    with _time('selection'):
+        entries = _apply_selection(table, data_config.selection if options['training'] else data_config.test_time_selection)
     if entries == 0:
-        return []
+        return 0
     # define new variables
-    _build_new_variables(table, data_config.var_funcs)
+    with _time('new_variables'):
+        # only those needed in this mode, releasing the intermediate ones as soon as possible
+        _build_new_variables(table, data_config.new_variables_plan(data_config.needed_branches(options['reweight'])))
     # check labels
     if data_config.label_type == 'simple':
         _check_labels(table)
     # build weights
     if options['reweight']:
-        _build_weights(table, data_config)
+        with _time('weights'):
+            _build_weights(table, data_config)
     # drop unused variables
     _clean_up(table, data_config.drop_branches)
     # perform input variable standardization, clipping, padding and stacking
-    _finalize_inputs(table, data_config)
+    with _time('finalize_inputs'):
+        _finalize_inputs(table, data_config)
+    return _num_entries(table)
+
+
+def _sample_indices(table, data_config, options, timer=None, rng=None):
+    if rng is None:
+        rng = np.random
     # compute reweight indices
-    if options['reweight'] and data_config.weight_name is not None:
-        indices = _get_reweight_indices(table[data_config.weight_name], up_sample=options['up_sample'],
-                                        weight_scale=options['weight_scale'], max_resample=options['max_resample'])
-    else:
-        indices = np.arange(len(table[data_config.label_names[0]]))
-    # shuffle
-    if options['shuffle']:
-        np.random.shuffle(indices)
+    with timer.time('sampling', entries=_num_entries(table)) if timer is not None else nullcontext():
+        if options['reweight'] and data_config.weight_name is not None:
+            indices = _get_reweight_indices(table[data_config.weight_name], up_sample=options['up_sample'],
+                                            weight_scale=options['weight_scale'], max_resample=options['max_resample'],
+                                            rng=rng)
+        else:
+            indices = np.arange(len(table[data_config.label_names[0]]))
+        # shuffle
+        if options['shuffle']:
+            rng.shuffle(indices)
     return indices
 
 
-def _load_next(data_config, filelist, load_range, options):
-    table = _read_files(filelist, data_config.load_branches, load_range, treename=data_config.treename)
-    indices = _preprocess(table, data_config, options)
-    return table, indices
+def _preprocess(table, data_config, options, timer=None, rng=None):
+    if options.get('preprocessed', False):
+        # already transformed by the conversion to shards (see `utils.data.shards`): only sample
+        return _sample_indices(table, data_config, options, timer=timer, rng=rng) if _num_entries(table) else []
+    if _transform(table, data_config, options, timer=timer) == 0:
+        return []
+    return _sample_indices(table, data_config, options, timer=timer, rng=rng)
+
+
+def _num_entries(table):
+    return len(next(iter(table.values()))) if len(table) else 0
+
+
+def _read_table(data_config, filelist, load_range, options):
+    if options.get('preprocessed', False):
+        return read_shards(filelist, data_config, load_range,
+                           with_weights=options['reweight'] and data_config.weight_name is not None)
+    # the selection is only used by the readers able to skip the chunks of data failing it (e.g., parquet)
+    return _read_files(filelist, data_config.load_branches, load_range, treename=data_config.treename,
+                       selection=data_config.selection if options['training'] else data_config.test_time_selection,
+                       float_branches=data_config.float_branches)
+
+
+def _load_next(data_config, filelist, load_range, options, timer=None, memory=None, rng=None):
+    start = time.perf_counter()
+    with timer.time('read') if timer is not None else nullcontext() as record:
+        table = _read_table(data_config, filelist, load_range, options)
+        if record is not None:
+            record.entries = _num_entries(table)
+    entries = _num_entries(table)
+    if memory is not None:
+        memory.record('rss_fetch', current_rss())
+    indices = _preprocess(table, data_config, options, timer=timer, rng=rng)
+    nbytes = table_nbytes(table)
+    if memory is not None:
+        memory.record('rss_preprocess', current_rss())
+        memory.record('table', nbytes)
+    # stats of this fetch, used by the auto mode of `fetch_step`
+    info = {'entries': entries, 'selected': _num_entries(table) if len(indices) else 0, 'nbytes': nbytes,
+            'time': time.perf_counter() - start}
+    return table, indices, info
 
 
 class _SimpleIter(object):
@@ -152,6 +220,10 @@ class _SimpleIter(object):
         self.indices = []
         self.cursor = 0
 
+        self._shared_base = None
+        self._prefetch_units = 0
+        self._fetch_tuner = {'throughput': None, 'grown': False, 'saturated': False}
+
         self._seed = None
         worker_info = torch.utils.data.get_worker_info()
         file_dict = self._init_file_dict.copy()
@@ -167,6 +239,9 @@ class _SimpleIter(object):
                 assert(len(new_files) > 0)
                 new_file_dict[name] = new_files
             file_dict = new_file_dict
+        # stream of the sampling and shuffling of the entries: reproducible per worker (the seed of a worker derives
+        # from the base seed of the DataLoader), or the global numpy one in the main process
+        self._rng = np.random.default_rng(self._seed) if self._seed is not None else np.random
         self.worker_file_dict = file_dict
         self.worker_filelist = sum(file_dict.values(), [])
         self.worker_info = worker_info
@@ -182,6 +257,19 @@ class _SimpleIter(object):
             num_files = int(len(filelist) * self._file_fraction)
             filelist = filelist[:num_files]
         self.filelist = filelist
+        # keep the files of this iterator open across the fetches, if they fit into the pool together w/ the files of
+        # the other iterators of this process (e.g., the train and val ones w/ `--num-workers 0`)
+        _root_file_pool.set_working_set(self, filelist)
+
+        if self._shared_table is not None:
+            # the whole (preprocessed) dataset is already in shared memory: only sample from it
+            self.table = self._shared_table.table
+            self.indices = self._sample_shared()
+            self.cursor = 0
+            self.prefetch = None
+            _logger.info('Restarted DataIter %s on the shared in-memory table (%d/%d entries)' %
+                         (self._name, len(self._shared_base), len(self._shared_table)))
+            return
 
         if self._init_load_range_and_fraction is None:
             self.load_range = (0, 1)
@@ -222,8 +310,10 @@ class _SimpleIter(object):
             while True:
                 if self._in_memory and len(self.indices) > 0:
                     # only need to re-shuffle the indices, if this is not the first entry
-                    if self._sampler_options['shuffle']:
-                        np.random.shuffle(self.indices)
+                    if self._shared_table is not None:
+                        self.indices = self._sample_shared()
+                    elif self._sampler_options['shuffle']:
+                        self._rng.shuffle(self.indices)
                     break
                 if self.prefetch is None:
                     # reaching the end as prefetch got nothing
@@ -233,9 +323,13 @@ class _SimpleIter(object):
                     raise StopIteration
                 # get result from prefetch
                 if self._async_load:
-                    self.table, self.indices = self.prefetch.result()
+                    waited = not self.prefetch.done()
+                    self.table, self.indices, info = self.prefetch.result()
                 else:
-                    self.table, self.indices = self.prefetch
+                    waited = True
+                    self.table, self.indices, info = self.prefetch
+                if self._fetch_step_auto:
+                    self._tune_fetch_step(info, waited)
                 # try to load the next ones asynchronously
                 self._try_get_next()
                 # check if any entries are fetched (i.e., passing selection) -- if not, do another fetch
@@ -262,21 +356,95 @@ class _SimpleIter(object):
                 self.prefetch = None
                 return
 
+        if self._memory_soft_limit is not None and not init:
+            self._check_memory()
+
         if self._fetch_by_files:
             filelist = self.filelist[int(self.ipos): int(self.ipos + self._fetch_step)]
             load_range = self.load_range
+            self._prefetch_units = len(filelist)
         else:
             filelist = self.filelist
             load_range = (self.ipos, min(self.ipos + self._fetch_step, self.load_range[1]))
+            self._prefetch_units = load_range[1] - load_range[0]
 
         # _logger.info('Start fetching next batch, len(filelist)=%d, load_range=%s'%(len(filelist), load_range))
         if self._async_load:
-            self.prefetch = self.executor.submit(_load_next, self._data_config,
-                                                 filelist, load_range, self._sampler_options)
+            self.prefetch = self.executor.submit(_load_next, self._data_config, filelist, load_range,
+                                                 self._sampler_options, self._timer, self._memory, self._rng)
         else:
-            self.prefetch = _load_next(self._data_config, filelist, load_range, self._sampler_options)
+            self.prefetch = _load_next(self._data_config, filelist, load_range, self._sampler_options,
+                                       self._timer, self._memory, self._rng)
         self.ipos += self._fetch_step
 
+    def _sample_shared(self):
+        # each iterator (i.e., each worker of each local rank) samples from its own strided subset of the entries
+        if self._shared_base is None:
+            num_workers = 1 if self.worker_info is None else self.worker_info.num_workers
+            worker_id = 0 if self.worker_info is None else self.worker_info.id
+            self._shared_base = np.arange(self._local_rank * num_workers + worker_id, len(self._shared_table),
+                                          self._local_world_size * num_workers)
+        base = self._shared_base
+        options = self._sampler_options
+        if options['reweight'] and self._data_config.weight_name is not None:
+            weights = self._shared_table.table[self._data_config.weight_name][base]
+            indices = base[_get_reweight_indices(weights, up_sample=options['up_sample'],
+                                                 weight_scale=options['weight_scale'],
+                                                 max_resample=options['max_resample'], rng=self._rng)]
+        else:
+            indices = base.copy()
+        if options['shuffle']:
+            self._rng.shuffle(indices)
+        return indices
+
+    def _tune_fetch_step(self, info, waited):
+        r"""Auto mode of ``fetch_step``: adapts the chunk size to the measured read throughput, the number of entries
+        passing the selection and the memory budget, aiming to keep the prefetch ahead of the consumer.
+
+        The step is doubled when the consumer had to wait for the chunk (i.e., the per-fetch overhead is not amortized)
+        or when too few entries pass the selection, as long as the read throughput keeps improving with larger chunks.
+        It is capped (or reduced) so that two preprocessed chunks fit in the memory budget.
+        """
+        if self._prefetch_units <= 0 or info['entries'] == 0:
+            return
+        tuner = self._fetch_tuner
+        throughput = info['entries'] / max(info['time'], 1e-6)
+        if tuner['grown'] and tuner['throughput'] is not None and throughput < 1.1 * tuner['throughput']:
+            # larger chunks do not read faster anymore: the reading is bound by the throughput, not the overhead
+            tuner['saturated'] = True
+        tuner['throughput'], tuner['grown'] = throughput, False
+
+        fetch_step = self._fetch_step
+        if info['selected'] < _AUTO_FETCH_MIN_ENTRIES or (waited and not tuner['saturated']):
+            fetch_step *= 2
+            tuner['grown'] = True
+        # memory cap: the current and the prefetched chunks are held at the same time
+        budget = 1e9 * (self._memory_soft_limit / 2 if self._memory_soft_limit is not None else _AUTO_FETCH_MEMORY_BUDGET)
+        bytes_per_unit = info['nbytes'] / self._prefetch_units
+        if bytes_per_unit > 0:
+            fetch_step = min(fetch_step, budget / 2 / bytes_per_unit)
+
+        if self._fetch_by_files:
+            fetch_step = int(min(max(1, fetch_step), len(self.filelist)))
+        else:
+            fetch_step = min(max(1e-4, fetch_step), self.load_range[1] - self.load_range[0])
+        if fetch_step != self._fetch_step:
+            _logger.info('DataIter %s: fetch_step %s -> %s (last fetch: %d entries read in %.2f s, %d selected, %.1f MB%s)',
+                         self._name, self._fetch_step, fetch_step, info['entries'], info['time'], info['selected'],
+                         info['nbytes'] / 1e6, ', consumer waited' if waited else '')
+            self._fetch_step = fetch_step
+
+    def _check_memory(self):
+        # soft limit: shrink the fetch step (of this worker only) if the RSS goes above the limit
+        rss = current_rss()
+        if rss <= self._memory_soft_limit * 1e9:
+            return
+        fetch_step = max(1, self._fetch_step // 2) if self._fetch_by_files else self._fetch_step / 2
+        if fetch_step < self._fetch_step:
+            _logger.warning('DataIter %s: RSS %.2f GB above the soft limit of %.2f GB, reducing fetch_step %s -> %s',
+                            self._name, rss / 1e9, self._memory_soft_limit, self._fetch_step, fetch_step)
+            self._fetch_step = fetch_step
+
     def get_data(self, i):
         # inputs
         X = {k: self.table['_' + k][i].copy() for k in self._data_config.input_names}
@@ -293,7 +461,8 @@ class SimpleIterDataset(torch.utils.data.IterableDataset):
     Handles dataloading.
 
     Arguments:
-        file_dict (dict): dictionary of lists of files to be loaded.
+        file_dict (dict): dictionary of lists of files to be loaded. These can also be the preprocessed shards written by
+            ``utils.convert.convert_to_shards``, in which case only the sampling (and shuffling) is performed.
         data_config_file (str): YAML file containing data format information.
         for_training (bool): flag indicating whether the dataset is used for training or testing.
             When set to ``True``, will enable shuffling and sampling-based reweighting.
@@ -308,23 +477,41 @@ class SimpleIterDataset(torch.utils.data.IterableDataset):
             Event shuffling and reweighting (sampling) is performed each time after we fetch data.
             So set this to a large enough value to avoid getting an imbalanced minibatch (due to reweighting/sampling), especially when ``fetch_by_files`` set to ``True``.
             Will load all events (files) at once if set to non-positive value.
+            If set to ``auto``, the step is adapted on the fly in each worker (see ``_SimpleIter._tune_fetch_step``).
         file_fraction (float): fraction of files to load.
+        shared_memory (bool): w/ ``in_memory``, load and preprocess the whole dataset only once (in the local rank 0),
+            into shared memory, instead of once in each worker; all the workers of all the local (DDP) ranks then
+            sample from their own subset of the entries. The files must not be split between the ranks.
+        memory_soft_limit (float): soft limit (in GB) on the RSS of each worker; the ``fetch_step`` of a worker is halved
+            every time its RSS is found above the limit before a fetch. Default is ``None`` (no limit).
     """
 
+    # data loading stages (in the workers), followed by the stages of the train/eval loops (in the main process)
+    timer_stages = ('read', 'selection', 'new_variables', 'weights', 'finalize_inputs', 'sampling', 'collate',
+                    'data_wait', 'h2d', 'model')
+    # RSS of the worker after reading / preprocessing each chunk, and estimated size of the preprocessed table
+    memory_gauges = ('rss_fetch', 'rss_preprocess', 'table')
+
     def __init__(self, file_dict, data_config_file, for_training=True, load_range_and_fraction=None,
                  fetch_by_files=False, fetch_step=0.01, file_fraction=1, remake_weights=False, up_sample=True,
-                 weight_scale=1, max_resample=10, async_load=True, infinity_mode=False, in_memory=False, name=''):
+                 weight_scale=1, max_resample=10, async_load=True, infinity_mode=False, in_memory=False,
+                 shared_memory=False, memory_soft_limit=None, name=''):
         self._iters = {} if infinity_mode or in_memory else None
         _init_args = set(self.__dict__.keys())
         self._init_file_dict = file_dict
         self._init_load_range_and_fraction = load_range_and_fraction
         self._fetch_by_files = fetch_by_files
-        self._fetch_step = fetch_step
+        self._fetch_step_auto = fetch_step == 'auto'
+        self._fetch_step = (1 if fetch_by_files else 0.01) if self._fetch_step_auto else fetch_step
         self._file_fraction = file_fraction
         self._async_load = async_load
         self._infinity_mode = infinity_mode
         self._in_memory = in_memory
+        self._memory_soft_limit = memory_soft_limit
         self._name = name
+        # per-stage timing, aggregated over all the iterators (i.e., DataLoader workers)
+        self._timer = StageTimer(self.timer_stages)
+        self._memory = MemoryMonitor(self.memory_gauges)
 
         # ==== sampling parameters ====
         self._sampler_options = {
@@ -338,6 +525,11 @@ class SimpleIterDataset(torch.utils.data.IterableDataset):
         else:
             self._sampler_options.update(training=False, shuffle=False, reweight=False)
 
+        # inputs already preprocessed by the conversion to shards (see `utils.convert`)?
+        filelist = sum(file_dict.values(), [])
+        shard = shard_info(filelist[0]) if len(filelist) else None
+        self._sampler_options['preprocessed'] = shard is not None
+
         # discover auto-generated reweight file
         data_config_md5 = _md5(data_config_file)
         data_config_autogen_file = data_config_file.replace('.yaml', '.%s.auto.yaml' % data_config_md5)
@@ -349,7 +541,18 @@ class SimpleIterDataset(torch.utils.data.IterableDataset):
         # load data config (w/ observers now -- so they will be included in the auto-generated yaml)
         self._data_config = DataConfig.load(data_config_file)
 
-        if for_training:
+        if shard is not None:
+            if shard['mode'] != ('train' if for_training else 'test'):
+                raise RuntimeError('The shards in %s were converted for %s, cannot be used for %s' % (
+                    os.path.dirname(filelist[0]), shard['mode'], 'training' if for_training else 'testing'))
+            if shard['data_config_md5'] != data_config_md5:
+                # the preprocessing stored in the shards would silently differ from the one of the data config
+                raise RuntimeError('The shards in %s were converted w/ a different data config (md5 %s) than the current '
+                                   'one (md5 %s), please convert them again' % (
+                                       os.path.dirname(filelist[0]), shard['data_config_md5'], data_config_md5))
+            _logger.info('Using preprocessed shards, the preprocessing (except for the sampling) will be skipped')
+
+        if for_training and shard is None:
             # produce variable standardization info if needed
             if self._data_config._missing_standardization_info:
                 s = AutoStandardizer(file_dict, self._data_config)
@@ -361,21 +564,79 @@ class SimpleIterDataset(torch.utils.data.IterableDataset):
                     w = WeightMaker(file_dict, self._data_config)
                     self._data_config = w.produce(data_config_autogen_file)
 
-            # reload data_config w/o observers for training
             if os.path.exists(data_config_autogen_file) and data_config_file != data_config_autogen_file:
                 data_config_file = data_config_autogen_file
                 _logger.info(
                     'Found file %s w/ auto-generated preprocessing information, will use that instead!' %
                     data_config_file)
+
+        if for_training:
+            # reload data_config w/o observers for training
             self._data_config = DataConfig.load(data_config_file, load_observers=False)
 
+        # in-memory dataset, preprocessed only once and shared by all the workers and the local (DDP) ranks
+        self._local_rank, self._local_world_size = 0, 1
+        self._shared_table = self._load_shared_table() if in_memory and shared_memory and file_dict else None
+
         # derive all variables added to self.__dict__
         self._init_args = set(self.__dict__.keys()) - _init_args
 
+    def _load_shared_table(self):
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if distributed:
+            self._local_rank = int(os.environ.get('LOCAL_RANK', 0))
+            self._local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        filelist = sorted(sum(self._init_file_dict.values(), []))
+        if self._file_fraction < 1:
+            filelist = filelist[:int(len(filelist) * self._file_fraction)]
+        if self._init_load_range_and_fraction is None:
+            load_range = (0, 1)
+        else:
+            (start_pos, end_pos), load_frac = self._init_load_range_and_fraction
+            load_range = (start_pos, start_pos + (end_pos - start_pos) * load_frac)
+        # all the local ranks (children of the same launcher) agree on the location w/o communicating
+        owner = os.getppid() if distributed else os.getpid()
+        key = hashlib.md5(json.dumps([owner, filelist, load_range, self._sampler_options['training']]).encode())
+        path = SharedTable.default_path(key.hexdigest()[:16])
+
+        if self._local_rank == 0:
+            start = time.perf_counter()
+            table = _read_table(self._data_config, filelist, load_range, self._sampler_options)
+            if not self._sampler_options['preprocessed']:
+                if _transform(table, self._data_config, self._sampler_options, timer=self._timer) == 0:
+                    raise RuntimeError('No entries passing the selection in dataset %s' % self._name)
+            names = shard_branches(self._data_config).values()
+            shared_table = SharedTable.create(path, {k: table[k] for k in names if k in table})
+            del table
+            _logger.info('Dataset %s: loaded %d entries (%.1f MB) into shared memory at %s in %.1f s' %
+                         (self._name, len(shared_table), shared_table.nbytes / 1e6, path, time.perf_counter() - start))
+        if distributed:
+            torch.distributed.barrier()
+        if self._local_rank != 0:
+            shared_table = SharedTable(path)
+        if multiprocessing.get_start_method() == 'fork':
+            # the DataLoader workers inherit the mappings: once all the local ranks have attached, remove the files
+            # right away, rather than at exit, so that they do not outlive a killed run (w/ `spawn` the workers
+            # re-attach by path, so the files are kept until the exit of local rank 0)
+            if distributed:
+                torch.distributed.barrier()
+            if self._local_rank == 0:
+                shared_table.unlink()
+        self._memory.record('table', shared_table.nbytes)
+        return shared_table
+
     @property
     def config(self):
         return self._data_config
 
+    @property
+    def timer(self):
+        return self._timer
+
+    @property
+    def memory(self):
+        return self._memory
+
     def __iter__(self):
         if self._iters is None:
             kwargs = {k: copy.deepcopy(self.__dict__[k]) for k in self._init_args}
@@ -7,7 +7,8 @@ Copyright (C) 2019 Sovrasov V. - All Rights Reserved
 '''
 
 import sys
-from functools import partial
+import math
+from functools import partial, wraps
 
 import numpy as np
 import torch
@@ -23,7 +24,15 @@ def get_model_complexity_info(model, inputs,
                               as_strings=True,
                               ost=sys.stdout,
                               verbose=False, ignore_modules=[],
-                              custom_modules_hooks={}):
+                              custom_modules_hooks={},
+                              count_functional=True,
+                              with_bytes=False):
+    """
+    Count the MACs and the parameters of a model (and, w/ `with_bytes=True`, the bytes read/written).
+    W/ `count_functional=True`, functional ops called in the `forward` of non-leaf modules (e.g., the matmul/topk
+    of the kNN, the index gather/repeat/cat of the graph features, softmax) are also counted, and attributed
+    to the module calling them.
+    """
     assert isinstance(model, nn.Module)
     global CUSTOM_MODULES_MAPPING
     CUSTOM_MODULES_MAPPING = custom_modules_hooks
@@ -32,17 +41,27 @@ def get_model_complexity_info(model, inputs,
     flops_model.start_flops_count(ost=ost, verbose=verbose,
                                   ignore_list=ignore_modules)
 
-    _ = flops_model(*inputs)
+    if count_functional:
+        patch_functional_ops()
+    try:
+        _ = flops_model(*inputs)
+    finally:
+        if count_functional:
+            unpatch_functional_ops()
 
     flops_count, params_count = flops_model.compute_average_flops_cost()
+    bytes_count = flops_model.compute_average_bytes()
     if print_per_layer_stat:
-        print_model_with_flops(flops_model, flops_count, params_count, ost=ost)
+        print_model_with_flops(flops_model, flops_count, params_count, total_bytes=bytes_count, ost=ost)
     flops_model.stop_flops_count()
     CUSTOM_MODULES_MAPPING = {}
 
     if as_strings:
-        return flops_to_string(flops_count), params_to_string(params_count)
+        flops_count, params_count, bytes_count = flops_to_string(flops_count), params_to_string(params_count), \
+            bytes_to_string(bytes_count)
 
+    if with_bytes:
+        return flops_count, params_count, bytes_count
     return flops_count, params_count
 
 
@@ -84,18 +103,38 @@ def params_to_string(params_num, units=None, precision=2):
             return str(params_num)
 
 
+def bytes_to_string(num_bytes, precision=2):
+    if num_bytes // 10**9 > 0:
+        return str(round(num_bytes / 10.**9, precision)) + ' GB'
+    elif num_bytes // 10**6 > 0:
+        return str(round(num_bytes / 10.**6, precision)) + ' MB'
+    elif num_bytes // 10**3 > 0:
+        return str(round(num_bytes / 10.**3, precision)) + ' KB'
+    else:
+        return str(num_bytes) + ' B'
+
+
 def accumulate_flops(self):
     if is_supported_instance(self):
         return self.__flops__
     else:
-        sum = 0
+        # functional ops called directly in the forward of this module
+        sum = getattr(self, '__functional_flops__', 0)
         for m in self.children():
             sum += m.accumulate_flops()
         return sum
 
 
+def accumulate_bytes(self):
+    sum = getattr(self, '__bytes__', 0)
+    if not is_supported_instance(self):
+        for m in self.children():
+            sum += accumulate_bytes(m)
+    return sum
+
+
 def print_model_with_flops(model, total_flops, total_params, units=None,
-                           precision=3, ost=sys.stdout):
+                           precision=3, ost=sys.stdout, total_bytes=None):
     if total_flops < 1:
         total_flops = 1
 
@@ -112,11 +151,16 @@ def print_model_with_flops(model, total_flops, total_params, units=None,
         accumulated_params_num = self.accumulate_params()
         accumulated_flops_cost = self.accumulate_flops() / model.__batch_counter__
         prefix = self.original_extra_repr() + ', |' if self.original_extra_repr() else '|'
-        return prefix + ', '.join([
+        stats = [
             params_to_string(accumulated_params_num, units='M', precision=precision),
             '{:.3%} Params'.format(accumulated_params_num / total_params),
             flops_to_string(accumulated_flops_cost, units=units, precision=precision),
-            '{:.3%} MACs'.format(accumulated_flops_cost / total_flops)]) + '|'
+            '{:.3%} MACs'.format(accumulated_flops_cost / total_flops)]
+        if total_bytes:
+            accumulated_bytes = accumulate_bytes(self) / model.__batch_counter__
+            stats += [bytes_to_string(accumulated_bytes, precision=precision),
+                      '{:.3%} Bytes'.format(accumulated_bytes / total_bytes)]
+        return prefix + ', '.join(stats) + '|'
 
     def add_extra_repr(m):
         m.accumulate_flops = accumulate_flops.__get__(m)
@@ -152,6 +196,7 @@ def add_flops_counting_methods(net_main_module):
     net_main_module.reset_flops_count = reset_flops_count.__get__(net_main_module)
     net_main_module.compute_average_flops_cost = compute_average_flops_cost.__get__(
         net_main_module)
+    net_main_module.compute_average_bytes = compute_average_bytes.__get__(net_main_module)
 
     net_main_module.reset_flops_count()
 
@@ -180,6 +225,17 @@ def compute_average_flops_cost(self):
     return flops_sum / self.__batch_counter__, params_sum
 
 
+def compute_average_bytes(self):
+    """
+    A method that will be available after add_flops_counting_methods() is called
+    on a desired net object.
+
+    Returns current mean number of bytes read/written per image.
+
+    """
+    return accumulate_bytes(self) / self.__batch_counter__
+
+
 def start_flops_count(self, **kwargs):
     """
     A method that will be available after add_flops_counting_methods() is called
@@ -207,15 +263,17 @@ def start_flops_count(self, **kwargs):
             else:
                 handle = module.register_forward_hook(MODULES_MAPPING[type(module)])
             module.__flops_handle__ = handle
+            module.__bytes_handle__ = module.register_forward_hook(bytes_counter_hook)
             seen_types.add(type(module))
         else:
             if verbose and not type(module) in (nn.Sequential, nn.ModuleList) and \
                not type(module) in seen_types:
                 _logger.info('Warning: module ' + type(module).__name__ +
-                             ' is treated as a zero-op.', color='lightgray')
+                             ' is treated as a zero-op (apart from the functional ops it calls).', color='lightgray')
             seen_types.add(type(module))
 
     self.apply(partial(add_flops_counter_hook_function, **kwargs))
+    self.apply(add_module_stack_hook_function)
 
 
 def stop_flops_count(self):
@@ -229,6 +287,7 @@ def stop_flops_count(self):
     """
     remove_batch_counter_hook_function(self)
     self.apply(remove_flops_counter_hook_function)
+    self.apply(remove_module_stack_hook_function)
 
 
 def reset_flops_count(self):
@@ -460,6 +519,8 @@ def remove_batch_counter_hook_function(module):
 
 
 def add_flops_counter_variable_or_reset(module):
+    module.__functional_flops__ = 0
+    module.__bytes__ = 0
     if is_supported_instance(module):
         if hasattr(module, '__flops__') or hasattr(module, '__params__'):
             _logger.info('Warning: variables __flops__ or __params__ are already '
@@ -529,3 +590,143 @@ def remove_flops_counter_hook_function(module):
         if hasattr(module, '__flops_handle__'):
             module.__flops_handle__.remove()
             del module.__flops_handle__
+        if hasattr(module, '__bytes_handle__'):
+            module.__bytes_handle__.remove()
+            del module.__bytes_handle__
+
+
+# ---- Functional ops
+# The module currently running its forward: functional ops are attributed to it, unless it is a supported
+# (i.e., leaf) module, whose hook already accounts for them (e.g., `nn.MultiheadAttention`).
+MODULE_STACK = []
+
+
+def _tensors(x):
+    if isinstance(x, torch.Tensor):
+        return [x]
+    elif isinstance(x, (list, tuple)):
+        return [t for v in x for t in _tensors(v)]
+    elif isinstance(x, dict):
+        return [t for v in x.values() for t in _tensors(v)]
+    return []
+
+
+def _nbytes(*args):
+    return sum(t.numel() * t.element_size() for t in _tensors(args))
+
+
+def bytes_counter_hook(module, input, output):
+    param_bytes = sum(p.numel() * p.element_size() for p in module.parameters())
+    module.__bytes__ += int(_nbytes(input, output) + param_bytes)
+
+
+def add_module_stack_hook_function(module):
+    if hasattr(module, '__stack_handles__'):
+        return
+    module.__stack_handles__ = (
+        module.register_forward_pre_hook(lambda m, input: MODULE_STACK.append(m)),
+        module.register_forward_hook(lambda m, input, output: MODULE_STACK.pop()))
+
+
+def remove_module_stack_hook_function(module):
+    if hasattr(module, '__stack_handles__'):
+        for handle in module.__stack_handles__:
+            handle.remove()
+        del module.__stack_handles__
+
+
+def matmul_flops(args, kwargs, output):
+    return output.numel() * args[0].shape[-1]
+
+
+def topk_flops(args, kwargs, output):
+    # heap-based selection: n * log2(k) comparisons
+    k = kwargs['k'] if 'k' in kwargs else args[1]
+    return int(args[0].numel() * max(1, math.ceil(math.log2(max(k, 2)))))
+
+
+def softmax_flops(args, kwargs, output):
+    # exp, sum, div
+    return 3 * output.numel()
+
+
+def reduce_flops(args, kwargs, output):
+    return args[0].numel()
+
+
+def memory_op_flops(args, kwargs, output):
+    # gather/repeat/cat only move data around
+    return 0
+
+
+def index_bytes(args, kwargs, output):
+    # advanced indexing reads only the gathered elements (and the indices)
+    if not _tensors(args[1]):
+        return None
+    return _nbytes(args[1]) + 2 * _nbytes(output)
+
+
+FUNCTIONAL_MAPPING = [
+    # (owner, name, flops_fn, bytes_fn): bytes_fn=None means all tensor inputs are read and all outputs written
+    (torch, 'matmul', matmul_flops, None),
+    (torch.Tensor, 'matmul', matmul_flops, None),
+    (torch.Tensor, '__matmul__', matmul_flops, None),
+    (torch, 'bmm', matmul_flops, None),
+    (torch.Tensor, 'bmm', matmul_flops, None),
+    (torch, 'topk', topk_flops, None),
+    (torch.Tensor, 'topk', topk_flops, None),
+    (torch, 'softmax', softmax_flops, None),
+    (torch.Tensor, 'softmax', softmax_flops, None),
+    (nn.functional, 'softmax', softmax_flops, None),
+    (torch.Tensor, 'log_softmax', softmax_flops, None),
+    (nn.functional, 'log_softmax', softmax_flops, None),
+    (torch, 'sum', reduce_flops, None),
+    (torch.Tensor, 'sum', reduce_flops, None),
+    (torch, 'mean', reduce_flops, None),
+    (torch.Tensor, 'mean', reduce_flops, None),
+    (torch, 'cat', memory_op_flops, None),
+    (torch, 'stack', memory_op_flops, None),
+    (torch.Tensor, 'repeat', memory_op_flops, None),
+    (torch, 'gather', memory_op_flops, None),
+    (torch.Tensor, 'gather', memory_op_flops, None),
+    (torch, 'index_select', memory_op_flops, None),
+    (torch.Tensor, 'index_select', memory_op_flops, None),
+    (torch.Tensor, '__getitem__', memory_op_flops, index_bytes),
+]
+
+_ORIGINAL_FUNCTIONAL_OPS = []
+
+
+def _wrap_functional_op(fn, flops_fn, bytes_fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        output = fn(*args, **kwargs)
+        if not MODULE_STACK or is_supported_instance(MODULE_STACK[-1]):
+            return output
+        num_bytes = _nbytes(args, kwargs, output) if bytes_fn is None else bytes_fn(args, kwargs, output)
+        if num_bytes is None:
+            return output
+        module = MODULE_STACK[-1]
+        module.__functional_flops__ += int(flops_fn(args, kwargs, output))
+        module.__bytes__ += int(num_bytes)
+        return output
+    return wrapper
+
+
+def patch_functional_ops():
+    if _ORIGINAL_FUNCTIONAL_OPS:
+        return
+    for owner, name, flops_fn, bytes_fn in FUNCTIONAL_MAPPING:
+        fn = getattr(owner, name)
+        # methods inherited by `torch.Tensor` (e.g., `__getitem__`) are restored by deleting the override
+        _ORIGINAL_FUNCTIONAL_OPS.append((owner, name, fn, name in vars(owner)))
+        setattr(owner, name, _wrap_functional_op(fn, flops_fn, bytes_fn))
+
+
+def unpatch_functional_ops():
+    while _ORIGINAL_FUNCTIONAL_OPS:
+        owner, name, fn, own_attr = _ORIGINAL_FUNCTIONAL_OPS.pop()
+        if own_attr:
+            setattr(owner, name, fn)
+        else:
+            delattr(owner, name)
@@ -0,0 +1,33 @@
+import importlib
+
+
+class LazyModule(object):
+    r"""LazyModule.
+
+    Stands for a module that is only imported when one of its attributes is first accessed, so that heavy optional
+    dependencies do not slow down the start-up of the jobs not using them.
+
+    Arguments:
+        name (str): name of the module.
+        loader (callable, optional): returns the module (e.g., w/ a fallback or a helpful error message);
+            defaults to ``importlib.import_module(name)``.
+    """
+
+    def __init__(self, name, loader=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_loader'] = loader
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = self._loader() if self._loader is not None else importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return '<lazy module %s%s>' % (self._name, '' if self._module is None else ' (loaded)')
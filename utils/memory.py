@@ -0,0 +1,76 @@
+import os
+
+from .logger import _logger
+from .timer import SharedCounters
+
+
+def current_rss():
+    r"""Resident set size (in bytes) of the current process."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        # peak RSS only, in kB on Linux
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def table_nbytes(table):
+    r"""Estimated memory (in bytes) held by the arrays of a table."""
+    nbytes = 0
+    for v in table.values():
+        try:
+            nbytes += v.nbytes
+        except AttributeError:
+            # awkward arrays
+            nbytes += getattr(getattr(v, 'content', None), 'nbytes', 0)
+    return nbytes
+
+
+class MemoryMonitor(SharedCounters):
+    r"""MemoryMonitor.
+
+    Tracks the high-water mark of memory gauges (e.g., the RSS after each fetch, or the size of the table after
+    preprocessing), per process, in all the DataLoader worker processes (see ``SharedCounters``).
+
+    Arguments:
+        gauges (list): names of the gauges.
+    """
+
+    def __init__(self, gauges):
+        self.gauges = tuple(gauges)
+        # [last, peak]
+        super(MemoryMonitor, self).__init__(self.gauges, 2)
+
+    def record(self, gauge, nbytes):
+        stat = self._stat(gauge)
+        with self._lock:
+            stat[0] = nbytes
+            stat[1] = max(stat[1].item(), nbytes)
+
+    def summary(self, reset=True):
+        r"""Peak value of each gauge: the maximum over all processes, and the list per process (main, worker0, ...)."""
+        peaks = self._stats[:, :, 1].clone()
+        if reset:
+            self._stats.zero_()
+        result = {}
+        for i, g in enumerate(self.gauges):
+            per_process = peaks[:, i].tolist()
+            if max(per_process) > 0:
+                # drop the trailing rows of workers not in use
+                last = max(j for j, v in enumerate(per_process) if v > 0)
+                result[g] = {'peak': max(per_process), 'per_process': per_process[:last + 1]}
+        return result
+
+    def log_summary(self, name, summary):
+        if not summary:
+            return
+        _logger.info('Memory high-water marks (%s):\n%s', name, '\n'.join(
+            '    - %-12s %10.1f MB  (per process: %s)' %
+            (g, v['peak'] / 1e6, ', '.join('%.0f' % (x / 1e6) for x in v['per_process']))
+            for g, v in summary.items()))
@@ -0,0 +1,114 @@
+import torch
+
+from contextlib import contextmanager
+from ..logger import _logger
+
+
+def _has_foreach():
+    return hasattr(torch, '_foreach_mul_') and hasattr(torch, '_foreach_add_')
+
+
+class WeightAverager(object):
+    r"""WeightAverager.
+
+    Keeps a running average (EMA or SWA) of the model weights, updated in place w/ multi-tensor ops.
+    The averaged weights can be swapped into the model (e.g., for validation or checkpointing) w/o any copy:
+    only the underlying storages of the parameters/buffers are exchanged.
+
+    Arguments:
+        model (torch.nn.Module): the (unwrapped) model to track.
+        mode (str): ``ema`` for exponential moving average, ``swa`` for the plain (stochastic weight) average.
+        decay (float): decay factor for ``ema``.
+        update_every (int): only update the average every N calls of ``update()``.
+    """
+
+    def __init__(self, model, mode='ema', decay=0.999, update_every=1):
+        if mode not in ('ema', 'swa'):
+            raise ValueError('Invalid weight averaging mode: %s' % mode)
+        if not 0.0 <= decay < 1.0:
+            raise ValueError('Invalid weight averaging decay: %s' % decay)
+        if update_every < 1:
+            raise ValueError('Invalid weight averaging update interval: %s' % update_every)
+        self.model = model
+        self.mode = mode
+        self.decay = decay
+        self.update_every = update_every
+        self.step_counter = 0
+        self.num_averaged = 0
+        self._swapped = False
+
+        # float tensors are averaged; integer buffers (e.g., `num_batches_tracked`) are swapped along w/o averaging
+        self._names, self._tensors = [], []
+        for name, t in list(model.named_parameters()) + list(model.named_buffers()):
+            self._names.append(name)
+            self._tensors.append(t)
+        self._avg_mask = [t.is_floating_point() for t in self._tensors]
+        self.shadow = [t.detach().clone() for t in self._tensors]
+        _logger.info('Tracking %s of %d tensors (decay=%s, update_every=%d)' %
+                     (mode.upper(), len(self._tensors), decay, update_every))
+
+    def _averaged_pairs(self):
+        shadow = [s for s, m in zip(self.shadow, self._avg_mask) if m]
+        current = [t.data for t, m in zip(self._tensors, self._avg_mask) if m]
+        return shadow, current
+
+    @torch.no_grad()
+    def update(self):
+        if self._swapped:
+            raise RuntimeError('Cannot update the weight average while the averaged weights are swapped in!')
+        self.step_counter += 1
+        if self.step_counter % self.update_every != 0:
+            return
+        if self.mode == 'ema':
+            keep = self.decay
+        else:
+            keep = self.num_averaged / (self.num_averaged + 1.)
+        self.num_averaged += 1
+
+        shadow, current = self._averaged_pairs()
+        if _has_foreach():
+            torch._foreach_mul_(shadow, keep)
+            torch._foreach_add_(shadow, current, alpha=1. - keep)
+        else:
+            for s, t in zip(shadow, current):
+                s.mul_(keep).add_(t, alpha=1. - keep)
+        # non-averaged tensors just follow the model
+        for s, t, m in zip(self.shadow, self._tensors, self._avg_mask):
+            if not m:
+                s.copy_(t.data)
+
+    def swap(self):
+        r"""Exchange the model weights and the averaged weights in place (no allocation, no copy)."""
+        for i, t in enumerate(self._tensors):
+            t.data, self.shadow[i] = self.shadow[i], t.data
+        self._swapped = not self._swapped
+
+    @contextmanager
+    def averaged(self):
+        r"""Context manager to temporarily run the model w/ the averaged weights."""
+        self.swap()
+        try:
+            yield self.model
+        finally:
+            self.swap()
+
+    def state_dict(self):
+        r"""The averaged weights (under ``state_dict``, in the same format as ``model.state_dict()``), and the counters
+        needed to resume the averaging."""
+        avg = self.shadow if not self._swapped else [t.data for t in self._tensors]
+        return {'state_dict': {name: t.detach().clone() for name, t in zip(self._names, avg)},
+                'num_averaged': self.num_averaged, 'step_counter': self.step_counter}
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict):
+        if 'state_dict' in state_dict:
+            weights = state_dict['state_dict']
+            self.num_averaged = state_dict['num_averaged']
+            self.step_counter = state_dict['step_counter']
+        else:
+            # older checkpoints: only the averaged weights, w/o the counters
+            weights = state_dict
+            self.num_averaged = max(1, self.num_averaged)
+        avg = self.shadow if not self._swapped else [t.data for t in self._tensors]
+        for name, t in zip(self._names, avg):
+            t.copy_(weights[name])
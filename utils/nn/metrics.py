@@ -1,8 +1,9 @@
 import numpy as np
 import traceback
-import sklearn.metrics as _m
-from functools import partial
 from ..logger import _logger
+from ..lazy import LazyModule
+
+_m = LazyModule('sklearn.metrics')
 
 # def _bkg_rejection(y_true, y_score, sig_eff):
 #     fpr, tpr, _ = _m.roc_curve(y_true, y_score)
@@ -46,7 +47,7 @@ def confusion_matrix(y_true, y_score):
 
 
 _metric_dict = {
-    'roc_auc_score': partial(_m.roc_auc_score, multi_class='ovo'),
+    'roc_auc_score': lambda y_true, y_score: _m.roc_auc_score(y_true, y_score, multi_class='ovo'),
     'roc_auc_score_matrix': roc_auc_score_ovo,
     'confusion_matrix': confusion_matrix,
     }
@@ -1,9 +1,30 @@
+import inspect
+import contextlib
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
+
+from typing import Optional
 
 '''Based on https://github.com/WangYueFt/dgcnn/blob/master/pytorch/model.py.'''
 
+_checkpoint_has_use_reentrant = 'use_reentrant' in inspect.signature(torch.utils.checkpoint.checkpoint).parameters
+
+
+@contextlib.contextmanager
+def _frozen_bn_stats(module):
+    # keep the running stats of the BN layers unchanged when recomputing the forward pass
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momenta = [bn.momentum for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.
+    try:
+        yield
+    finally:
+        for bn, momentum in zip(bns, momenta):
+            bn.momentum = momentum
+
 
 def knn(x, k):
     inner = -2 * torch.matmul(x.transpose(2, 1), x)
@@ -63,15 +84,19 @@ class EdgeConvBlock(nn.Module):
         Output feature size.
     batch_norm : bool
         Whether to include batch normalization on messages.
+    use_checkpoint : bool
+        Whether to recompute the block internals (graph features, convs) in the backward pass
+        instead of storing them, to reduce the activation memory in training.
     """
 
-    def __init__(self, k, in_feat, out_feats, batch_norm=True, activation=True, cpu_mode=False):
+    def __init__(self, k, in_feat, out_feats, batch_norm=True, activation=True, cpu_mode=False, use_checkpoint=False):
         super(EdgeConvBlock, self).__init__()
         self.k = k
+        self.use_checkpoint = use_checkpoint
         self.batch_norm = batch_norm
         self.activation = activation
         self.num_layers = len(out_feats)
-        self.get_graph_feature = get_graph_feature_v2 if cpu_mode else get_graph_feature_v1
+        self.cpu_mode = cpu_mode
 
         self.convs = nn.ModuleList()
         for i in range(self.num_layers):
@@ -96,22 +121,58 @@ class EdgeConvBlock(nn.Module):
         if activation:
             self.sc_act = nn.ReLU()
 
+    def __setstate__(self, state):
+        super(EdgeConvBlock, self).__setstate__(state)
+        # full models (e.g., `_best_epoch_full.pt`) pickled w/ earlier versions of this class
+        get_graph_feature = self.__dict__.pop('get_graph_feature', None)
+        if get_graph_feature is not None:
+            self.cpu_mode = get_graph_feature is get_graph_feature_v2
+        if 'use_checkpoint' not in self.__dict__:
+            self.use_checkpoint = False
+
     def forward(self, points, features):
+        # activation checkpointing is not available in TorchScript
+        if not torch.jit.is_scripting() and self.use_checkpoint and self.training and torch.is_grad_enabled():
+            if _checkpoint_has_use_reentrant or points.requires_grad or features.requires_grad:
+                return self._forward_with_checkpoint(points, features)
+        return self._forward(points, features)
+
+    @torch.jit.unused
+    def _forward_with_checkpoint(self, points, features):
+        if _checkpoint_has_use_reentrant:
+            return torch.utils.checkpoint.checkpoint(self._checkpointed_forward(), points, features, use_reentrant=False)
+        else:
+            # the reentrant implementation only propagates gradients if any of the inputs requires grad
+            return torch.utils.checkpoint.checkpoint(self._checkpointed_forward(), points, features)
+
+    @torch.jit.unused
+    def _checkpointed_forward(self):
+        state = {'recompute': False}
+
+        def _fn(points, features):
+            ctx = _frozen_bn_stats(self) if state['recompute'] else contextlib.nullcontext()
+            state['recompute'] = True
+            with ctx:
+                return self._forward(points, features)
+        return _fn
+
+    def _forward(self, points, features):
 
         topk_indices = knn(points, self.k)
-        x = self.get_graph_feature(features, self.k, topk_indices)
+        if self.cpu_mode:
+            x = get_graph_feature_v2(features, self.k, topk_indices)
+        else:
+            x = get_graph_feature_v1(features, self.k, topk_indices)
 
         for conv, bn, act in zip(self.convs, self.bns, self.acts):
             x = conv(x)  # (N, C', P, K)
-            if bn:
-                x = bn(x)
-            if act:
-                x = act(x)
+            x = bn(x)
+            x = act(x)
 
         fts = x.mean(dim=-1)  # (N, C, P)
 
         # shortcut
-        if self.sc:
+        if self.sc is not None:
             sc = self.sc(features)  # (N, C_out, P)
             sc = self.sc_bn(sc)
         else:
@@ -132,26 +193,34 @@ class ParticleNet(nn.Module):
                  use_counts=True,
                  for_inference=False,
                  for_segmentation=False,
+                 checkpoint_edge_convs=False,
                  **kwargs):
         super(ParticleNet, self).__init__(**kwargs)
 
         self.use_fts_bn = use_fts_bn
-        if self.use_fts_bn:
-            self.bn_fts = nn.BatchNorm1d(input_dims)
+        self.bn_fts = nn.BatchNorm1d(input_dims) if self.use_fts_bn else None
 
         self.use_counts = use_counts
 
+        # activation checkpointing: `True` for all EdgeConv blocks, or a list of block indices
+        if isinstance(checkpoint_edge_convs, bool):
+            checkpoint_edge_convs = range(len(conv_params)) if checkpoint_edge_convs else []
+        checkpoint_edge_convs = set(checkpoint_edge_convs)
+
         self.edge_convs = nn.ModuleList()
         for idx, layer_param in enumerate(conv_params):
             k, channels = layer_param
             in_feat = input_dims if idx == 0 else conv_params[idx - 1][1][-1]
-            self.edge_convs.append(EdgeConvBlock(k=k, in_feat=in_feat, out_feats=channels, cpu_mode=for_inference))
+            self.edge_convs.append(EdgeConvBlock(k=k, in_feat=in_feat, out_feats=channels, cpu_mode=for_inference,
+                                                 use_checkpoint=idx in checkpoint_edge_convs))
 
         self.use_fusion = use_fusion
         if self.use_fusion:
             in_chn = sum(x[-1] for _, x in conv_params)
             out_chn = np.clip((in_chn // 128) * 128, 128, 1024)
             self.fusion_block = nn.Sequential(nn.Conv1d(in_chn, out_chn, kernel_size=1, bias=False), nn.BatchNorm1d(out_chn), nn.ReLU())
+        else:
+            self.fusion_block = None
 
         self.for_segmentation = for_segmentation
 
@@ -175,7 +244,15 @@ class ParticleNet(nn.Module):
 
         self.for_inference = for_inference
 
-    def forward(self, points, features, mask=None):
+    def __setstate__(self, state):
+        super(ParticleNet, self).__setstate__(state)
+        # full models (e.g., `_best_epoch_full.pt`) pickled w/ earlier versions of this class
+        if not hasattr(self, 'bn_fts'):
+            self.bn_fts = None
+        if not hasattr(self, 'fusion_block'):
+            self.fusion_block = None
+
+    def forward(self, points, features, mask: Optional[torch.Tensor] = None):
 #         print('points:\n', points)
 #         print('features:\n', features)
         if mask is None:
@@ -183,11 +260,8 @@ class ParticleNet(nn.Module):
         points *= mask
         features *= mask
         coord_shift = (mask == 0) * 1e9
-        if self.use_counts:
-            counts = mask.float().sum(dim=-1)
-            counts = torch.max(counts, torch.ones_like(counts))  # >=1
 
-        if self.use_fts_bn:
+        if self.bn_fts is not None:
             fts = self.bn_fts(features) * mask
         else:
             fts = features
@@ -197,7 +271,7 @@ class ParticleNet(nn.Module):
             fts = conv(pts, fts) * mask
             if self.use_fusion:
                 outputs.append(fts)
-        if self.use_fusion:
+        if self.fusion_block is not None:
             fts = self.fusion_block(torch.cat(outputs, dim=1)) * mask
 
 #         assert(((fts.abs().sum(dim=1, keepdim=True) != 0).float() - mask.float()).abs().sum().item() == 0)
@@ -206,6 +280,8 @@ class ParticleNet(nn.Module):
             x = fts
         else:
             if self.use_counts:
+                counts = mask.float().sum(dim=-1)
+                counts = torch.max(counts, torch.ones_like(counts))  # >=1
                 x = fts.sum(dim=-1) / counts  # divide by the real counts
             else:
                 x = fts.mean(dim=-1)
@@ -246,6 +322,7 @@ class ParticleNetTagger(nn.Module):
                  pf_input_dropout=None,
                  sv_input_dropout=None,
                  for_inference=False,
+                 checkpoint_edge_convs=False,
                  **kwargs):
         super(ParticleNetTagger, self).__init__(**kwargs)
         self.pf_input_dropout = nn.Dropout(pf_input_dropout) if pf_input_dropout else None
@@ -259,14 +336,15 @@ class ParticleNetTagger(nn.Module):
                               use_fusion=use_fusion,
                               use_fts_bn=use_fts_bn,
                               use_counts=use_counts,
-                              for_inference=for_inference)
+                              for_inference=for_inference,
+                              checkpoint_edge_convs=checkpoint_edge_convs)
 
     def forward(self, pf_points, pf_features, pf_mask, sv_points, sv_features, sv_mask):
-        if self.pf_input_dropout:
+        if self.pf_input_dropout is not None:
             pf_mask = (self.pf_input_dropout(pf_mask) != 0).float()
             pf_points *= pf_mask
             pf_features *= pf_mask
-        if self.sv_input_dropout:
+        if self.sv_input_dropout is not None:
             sv_mask = (self.sv_input_dropout(sv_mask) != 0).float()
             sv_points *= sv_mask
             sv_features *= sv_mask
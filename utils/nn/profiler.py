@@ -0,0 +1,123 @@
+import sys
+import functools
+
+from torch.autograd.profiler import record_function
+from ..logger import _logger
+
+MODULE_PREFIX = 'module::'
+FUNCTION_PREFIX = 'function::'
+
+
+def _get(evt, *names):
+    # the attribute names differ between PyTorch versions (e.g., `cuda_time_total` -> `device_time_total`)
+    for name in names:
+        if hasattr(evt, name):
+            return getattr(evt, name)
+    return 0
+
+
+class ModuleProfiler(object):
+    r"""ModuleProfiler.
+
+    Labels the forward (and backward) passes of the selected submodules, and the calls of the selected functions,
+    as ``record_function`` ranges, so that ``torch.profiler`` attributes the time and the memory to them.
+    The hooks are only installed within the ``with`` block.
+
+    Arguments:
+        model (torch.nn.Module): the model to profile.
+        targets (list): class names (e.g., ``EdgeConvBlock``) or attribute names (e.g., ``fc``) of the submodules.
+        functions (list): names of the functions (e.g., ``knn``), looked up in the python modules defining
+            the selected submodules.
+    """
+
+    def __init__(self, model, targets=('EdgeConvBlock', 'fusion_block', 'fc'),
+                 functions=('knn', 'get_graph_feature_v1', 'get_graph_feature_v2')):
+        self.model = model
+        self.targets = set(targets)
+        self.functions = tuple(functions)
+        self._handles = []
+        self._patched = []
+        self._open = {}
+
+    def _enter(self, label):
+        rf = record_function(label)
+        rf.__enter__()
+        self._open.setdefault(label, []).append(rf)
+
+    def _exit(self, label):
+        stack = self._open.get(label)
+        if stack:
+            stack.pop().__exit__(None, None, None)
+
+    def _label_module(self, name, module):
+        label = '%s%s (%s)' % (MODULE_PREFIX, name, type(module).__name__)
+        self._handles.append(module.register_forward_pre_hook(lambda m, inputs: self._enter(label)))
+        self._handles.append(module.register_forward_hook(lambda m, inputs, output: self._exit(label)))
+        if hasattr(module, 'register_full_backward_pre_hook'):
+            self._handles.append(module.register_full_backward_pre_hook(
+                lambda m, grad_output: self._enter(label + '.backward')))
+            self._handles.append(module.register_full_backward_hook(
+                lambda m, grad_input, grad_output: self._exit(label + '.backward')))
+
+    def _label_function(self, pymodule, name):
+        fn = getattr(pymodule, name)
+
+        @functools.wraps(fn)
+        def _fn(*args, **kwargs):
+            with record_function(FUNCTION_PREFIX + name):
+                return fn(*args, **kwargs)
+        setattr(pymodule, name, _fn)
+        self._patched.append((pymodule, name, fn))
+
+    def __enter__(self):
+        pymodules = []
+        num_modules = 0
+        for name, module in self.model.named_modules():
+            if name and (type(module).__name__ in self.targets or name.split('.')[-1] in self.targets):
+                self._label_module(name, module)
+                num_modules += 1
+                pymodule = sys.modules[type(module).__module__]
+                if pymodule not in pymodules:
+                    pymodules.append(pymodule)
+        for pymodule in pymodules:
+            for name in self.functions:
+                if callable(getattr(pymodule, name, None)):
+                    self._label_function(pymodule, name)
+        _logger.info('Profiling %d submodules and %d functions', num_modules, len(self._patched))
+        return self
+
+    def __exit__(self, *exc):
+        for h in self._handles:
+            h.remove()
+        for pymodule, name, fn in reversed(self._patched):
+            setattr(pymodule, name, fn)
+        for stack in self._open.values():
+            while stack:
+                stack.pop().__exit__(None, None, None)
+        self._handles, self._patched, self._open = [], [], {}
+
+
+def module_summary(prof):
+    r"""Time (ms, summed over the active steps) and memory (MB, net allocation) of the labeled submodules/functions."""
+    rows = []
+    for evt in prof.key_averages():
+        if evt.key.startswith(MODULE_PREFIX) or evt.key.startswith(FUNCTION_PREFIX):
+            rows.append({
+                'name': evt.key,
+                'calls': evt.count,
+                'cpu_time_ms': evt.cpu_time_total / 1e3,
+                'cuda_time_ms': _get(evt, 'device_time_total', 'cuda_time_total') / 1e3,
+                'cpu_memory_MB': evt.cpu_memory_usage / 1e6,
+                'cuda_memory_MB': _get(evt, 'device_memory_usage', 'cuda_memory_usage') / 1e6,
+            })
+    return sorted(rows, key=lambda r: (-r['cuda_time_ms'], -r['cpu_time_ms']))
+
+
+def format_module_summary(rows):
+    lines = ['%-60s %8s %14s %14s %14s %15s' % ('Name', 'Calls', 'CPU time (ms)', 'CUDA time (ms)',
+                                               'CPU mem (MB)', 'CUDA mem (MB)')]
+    for r in rows:
+        lines.append('%-60s %8d %14.2f %14.2f %14.2f %15.2f' % (r['name'], r['calls'], r['cpu_time_ms'],
+                                                               r['cuda_time_ms'], r['cpu_memory_MB'],
+                                                               r['cuda_memory_MB']))
+    return '\n'.join(lines)
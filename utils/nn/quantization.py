@@ -0,0 +1,106 @@
+import os
+import time
+import numpy as np
+
+from ..logger import _logger
+
+# Only the (1x1) convolutions and the fully connected layers are quantized / converted:
+# the kNN part operates on coordinates shifted by 1e9 for the padded entries (see `ParticleNet.forward`),
+# which overflows in fp16 and would dominate the int8 quantization range.
+_INT8_OP_TYPES = ['Conv', 'Gemm']
+_FP16_OP_BLOCK_LIST = ['Add', 'Sub', 'Mul', 'Div', 'Neg', 'Pow', 'MatMul', 'TopK', 'ReduceSum', 'ReduceMean', 'Softmax']
+
+ONNX_VARIANTS = ('int8-dynamic', 'int8-static', 'fp16')
+
+
+def _to_numpy_inputs(X, input_names):
+    return {k: X[k].cpu().numpy().astype('float32') for k in input_names}
+
+
+def _sample_inputs(data_loader, input_names, num_batches):
+    samples = []
+    for X, _, _ in data_loader:
+        samples.append(_to_numpy_inputs(X, input_names))
+        if len(samples) >= num_batches:
+            break
+    if len(samples) == 0:
+        raise RuntimeError('No data available from the data loader!')
+    return samples
+
+
+def variant_path(model_path, variant):
+    base, ext = os.path.splitext(model_path)
+    return '%s.%s%s' % (base, variant, ext)
+
+
+def quantize_onnx(model_path, variant, input_names, calib_loader=None, num_calib_batches=10):
+    r"""Produce a quantized (``int8-dynamic``, ``int8-static``) or half precision (``fp16``) variant of an ONNX model.
+
+    The static quantization is calibrated on ``num_calib_batches`` batches from ``calib_loader``.
+    Returns the path of the new model.
+    """
+    if variant not in ONNX_VARIANTS:
+        raise ValueError('Invalid ONNX model variant: %s' % variant)
+    output_path = variant_path(model_path, variant)
+
+    if variant == 'fp16':
+        try:
+            import onnx
+            from onnxconverter_common import float16
+        except ImportError:
+            raise ImportError('Please install onnx and onnxconverter-common with `pip install onnx onnxconverter-common`.')
+        model = onnx.load(model_path)
+        model = float16.convert_float_to_float16(model, keep_io_types=True, op_block_list=_FP16_OP_BLOCK_LIST)
+        onnx.save(model, output_path)
+    else:
+        try:
+            from onnxruntime import quantization
+        except ImportError:
+            raise ImportError('Please install onnxruntime with `pip install onnxruntime`.')
+        if variant == 'int8-dynamic':
+            quantization.quantize_dynamic(model_path, output_path, op_types_to_quantize=_INT8_OP_TYPES,
+                                          weight_type=quantization.QuantType.QInt8)
+        else:
+            if calib_loader is None:
+                raise RuntimeError('Static quantization requires calibration data, please set `--data-test`.')
+
+            class _CalibrationDataReader(quantization.CalibrationDataReader):
+
+                def __init__(self):
+                    self.samples = iter(_sample_inputs(calib_loader, input_names, num_calib_batches))
+
+                def get_next(self):
+                    return next(self.samples, None)
+
+            quantization.quantize_static(model_path, output_path, _CalibrationDataReader(),
+                                         quant_format=quantization.QuantFormat.QDQ,
+                                         op_types_to_quantize=_INT8_OP_TYPES, per_channel=True,
+                                         activation_type=quantization.QuantType.QInt8,
+                                         weight_type=quantization.QuantType.QInt8)
+    _logger.info('ONNX model (%s) saved to %s', variant, output_path)
+    return output_path
+
+
+def compare_onnx(ref_model_path, model_paths, data_loader, input_names, num_batches=20):
+    r"""Compare the latency and the scores of ONNX models w/ the reference (fp32) model on CPU."""
+    import onnxruntime
+    samples = _sample_inputs(data_loader, input_names, num_batches)
+    num_entries = sum(len(s[input_names[0]]) for s in samples)
+
+    def _run(path):
+        sess = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        sess.run([], samples[0])  # warm-up
+        start = time.time()
+        outputs = [sess.run([], s)[0] for s in samples]
+        return np.concatenate(outputs).astype('float32'), time.time() - start
+
+    ref_scores, ref_time = _run(ref_model_path)
+    _logger.info('[%s] %.1f entries/s', os.path.basename(ref_model_path), num_entries / ref_time)
+    results = {}
+    for path in model_paths:
+        scores, t = _run(path)
+        diff = np.abs(scores - ref_scores)
+        results[path] = {'speedup': ref_time / t, 'max_abs_diff': float(diff.max()), 'mean_abs_diff': float(diff.mean())}
+        _logger.info('[%s] %.1f entries/s (speedup x%.2f), score deviation w.r.t. fp32: max %.3e, mean %.3e',
+                     os.path.basename(path), num_entries / t, ref_time / t, diff.max(), diff.mean(), color='bold')
+    return results
@@ -1,12 +1,18 @@
 import numpy as np
-import tqdm
+import math
 import time
 import torch
+import contextlib
 
 from collections import defaultdict, Counter
 from .metrics import evaluate_metrics
 from ..data.tools import awkward, _concat
 from ..logger import _logger
+from ..timer import StepMeter
+from ..lazy import LazyModule
+
+# only imported once a train/eval loop actually runs
+tqdm = LazyModule('tqdm')
 
 
 def _flatten_label(label, mask=None):
@@ -29,11 +35,180 @@ def _flatten_preds(preds, mask=None, label_axis=1):
     return preds
 
 
-def train_classification(model, loss_func, opt, scheduler, train_loader, dev, epoch, steps_per_epoch=None, grad_scaler=None, tb_helper=None):
+def _report_timing(timer, meter, mode, tb_helper=None, epoch=None):
+    summary = meter.summary(reset=True)
+    if 'step' in summary:
+        _logger.info('Time per step: %.1f ms (data wait %.1f ms, h2d %.1f ms, model %.1f ms) -- '
+                     'stall fraction: %.3f, %s busy fraction: %.3f' % (
+                         1000. * summary['step'] / summary['num_steps'],
+                         1000. * summary.get('data_wait', 0) / summary['num_steps'],
+                         1000. * summary.get('h2d', 0) / summary['num_steps'],
+                         1000. * summary.get('model', 0) / summary['num_steps'],
+                         summary['stall_fraction'], 'GPU' if meter.use_cuda else 'CPU', summary['busy_fraction']))
+    if timer is not None:
+        stages = timer.summary(reset=True)
+        timer.log_summary(mode, stages)
+    else:
+        stages = {}
+    if tb_helper and epoch is not None:
+        write_info = [("Timing/%s/%s (epoch)" % (mode, stage), v['time'], epoch) for stage, v in stages.items()]
+        if 'step' in summary:
+            write_info += [("Stall/%s (epoch)" % mode, summary['stall_fraction'], epoch),
+                           ("Busy/%s (epoch)" % mode, summary['busy_fraction'], epoch)]
+        tb_helper.write_scalars(write_info)
+
+
+def _report_memory(memory, dev, mode, tb_helper=None, epoch=None):
+    write_info = []
+    if memory is not None:
+        summary = memory.summary(reset=True)
+        memory.log_summary(mode, summary)
+        write_info += [("Memory/%s/%s (epoch)" % (mode, g), v['peak'] / 1e6, epoch) for g, v in summary.items()]
+    if dev is not None and dev.type == 'cuda' and torch.cuda.is_available():
+        max_allocated = torch.cuda.max_memory_allocated(dev)
+        _logger.info('GPU max memory allocated (%s): %.1f MB' % (mode, max_allocated / 1e6))
+        torch.cuda.reset_peak_memory_stats(dev)
+        write_info.append(("Memory/%s/gpu_max_allocated (epoch)" % mode, max_allocated / 1e6, epoch))
+    if tb_helper and epoch is not None:
+        tb_helper.write_scalars(write_info)
+
+
+def _is_oom_error(e):
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+class _GradientAccumulator(object):
+    r"""Runs the forward/backward passes and the optimizer steps of the training loop.
+
+    Gradients are accumulated over ``grad_accum_steps`` batches before each optimizer step.
+    Each batch can be further split into micro-batches (at most ``micro_batch_size`` entries each);
+    when a CUDA out-of-memory error occurs, the number of micro-batches is doubled and the batch is retried
+    (except w/ DistributedDataParallel: a retry on a single rank would desynchronize the collectives of the ranks).
+    """
+
+    def __init__(self, model, opt, scheduler=None, grad_scaler=None, weight_averager=None,
+                 grad_accum_steps=1, micro_batch_size=None):
+        self.model = model
+        self.opt = opt
+        self.scheduler = scheduler
+        self.grad_scaler = grad_scaler
+        self.weight_averager = weight_averager
+        self.grad_accum_steps = max(1, grad_accum_steps)
+        self.micro_batch_size = micro_batch_size
+        self.num_splits = 1
+        self.accum_count = 0
+        self.opt.zero_grad()
+
+    def _forward_backward(self, loss_fn, inputs, targets, num_examples, num_splits, sync):
+        num_splits = max(1, min(num_splits, inputs[0].shape[0]))
+
+        def _split(x):
+            return [None] * num_splits if x is None else torch.tensor_split(x, num_splits)
+
+        total_loss = 0
+        model_outputs, preds = [], []
+        for i, chunk in enumerate(zip(*[_split(x) for x in inputs + targets])):
+            chunk_inputs, chunk_targets = chunk[:len(inputs)], chunk[len(inputs):]
+            # DDP: only all-reduce the gradients on the very last backward pass before the optimizer step
+            no_sync = getattr(self.model, 'no_sync', None)
+            ctx = no_sync() if no_sync is not None and not (sync and i == num_splits - 1) else contextlib.nullcontext()
+            with ctx:
+                with torch.cuda.amp.autocast(enabled=self.grad_scaler is not None):
+                    model_output = self.model(*chunk_inputs)
+                    pred, loss, n = loss_fn(model_output, *chunk_targets)
+                    # losses are averaged over the entries: re-weight w/ the micro-batch size
+                    loss = loss * (n / num_examples)
+                scaled_loss = loss / self.grad_accum_steps
+                if self.grad_scaler is None:
+                    scaled_loss.backward()
+                else:
+                    self.grad_scaler.scale(scaled_loss).backward()
+            total_loss += loss.detach()
+            model_outputs.append(model_output.detach())
+            preds.append(pred.detach())
+        if num_splits == 1:
+            return model_outputs[0], preds[0], total_loss
+        return torch.cat(model_outputs), torch.cat(preds), total_loss
+
+    def _optimizer_step(self):
+        if self.grad_scaler is None:
+            self.opt.step()
+        else:
+            self.grad_scaler.step(self.opt)
+            self.grad_scaler.update()
+        self.opt.zero_grad()
+        self.accum_count = 0
+
+        if self.weight_averager is not None:
+            self.weight_averager.update()
+
+        if self.scheduler and getattr(self.scheduler, '_update_per_step', False):
+            self.scheduler.step()
+
+    def step(self, loss_fn, inputs, targets, num_examples, last_batch=False):
+        r"""Process one batch. ``loss_fn(model_output, *targets)`` should return ``(preds, loss, num_examples)``.
+
+        Returns the model output, the predictions and the loss of the full batch (all detached).
+        """
+        if self.micro_batch_size:
+            self.num_splits = max(self.num_splits, math.ceil(inputs[0].shape[0] / self.micro_batch_size))
+        while True:
+            do_step = last_batch or self.accum_count + 1 >= self.grad_accum_steps
+            try:
+                outputs = self._forward_backward(loss_fn, inputs, targets, num_examples, self.num_splits, sync=do_step)
+                break
+            except RuntimeError as e:
+                if not _is_oom_error(e) or self.num_splits >= inputs[0].shape[0] or hasattr(self.model, 'no_sync'):
+                    raise
+                # the gradients are partially accumulated: discard the current accumulation cycle and retry
+                del e
+                self.opt.zero_grad()
+                if self.accum_count > 0:
+                    _logger.warning('Discarding the gradients accumulated over the last %d batches.' % self.accum_count)
+                self.accum_count = 0
+                torch.cuda.empty_cache()
+                self.num_splits *= 2
+                _logger.warning('CUDA out of memory: splitting each batch into %d micro-batches.' % self.num_splits)
+        self.accum_count += 1
+        if do_step:
+            self._optimizer_step()
+        return outputs
+
+    def flush(self):
+        r"""Take an optimizer step w/ the gradients of an incomplete accumulation cycle (e.g., at the end of an epoch)."""
+        if self.accum_count == 0:
+            return
+        if hasattr(self.model, 'no_sync'):
+            # gradients of the pending cycle have not been all-reduced across the ranks
+            _logger.warning('Discarding the gradients accumulated over the last %d batches.' % self.accum_count)
+            self.opt.zero_grad()
+            self.accum_count = 0
+            return
+        # rescale so the gradients are averaged over the batches actually accumulated
+        with torch.no_grad():
+            for group in self.opt.param_groups:
+                for p in group['params']:
+                    if p.grad is not None:
+                        p.grad.mul_(self.grad_accum_steps / self.accum_count)
+        self._optimizer_step()
+
+
+def train_classification(model, loss_func, opt, scheduler, train_loader, dev, epoch, steps_per_epoch=None, grad_scaler=None, tb_helper=None,
+                         weight_averager=None, grad_accum_steps=1, micro_batch_size=None):
     model.train()
 
     data_config = train_loader.dataset.config
 
+    def _loss_fn(model_output, label, label_mask):
+        logits = _flatten_preds(model_output, label_mask)
+        label = _flatten_label(label, label_mask)
+        return logits, loss_func(logits, label), label.shape[0]
+
+    accumulator = _GradientAccumulator(model, opt, scheduler, grad_scaler=grad_scaler, weight_averager=weight_averager,
+                                       grad_accum_steps=grad_accum_steps, micro_batch_size=micro_batch_size)
+    timer = getattr(train_loader.dataset, 'timer', None)
+    meter = StepMeter(dev, timer)
+
     label_counter = Counter()
     total_loss = 0
     num_batches = 0
@@ -41,32 +216,23 @@ def train_classification(model, loss_func, opt, scheduler, train_loader, dev, ep
     count = 0
     start_time = time.time()
     with tqdm.tqdm(train_loader) as tq:
-        for X, y, _ in tq:
-            inputs = [X[k].to(dev) for k in data_config.input_names]
-            label = y[data_config.label_names[0]].long()
-            try:
-                label_mask = y[data_config.label_names[0] + '_mask'].bool()
-            except KeyError:
-                label_mask = None
-            label = _flatten_label(label, label_mask)
-            num_examples = label.shape[0]
-            label_counter.update(label.cpu().numpy())
-            label = label.to(dev)
-            opt.zero_grad()
-            with torch.cuda.amp.autocast(enabled=grad_scaler is not None):
-                model_output = model(*inputs)
-                logits = _flatten_preds(model_output, label_mask)
-                loss = loss_func(logits, label)
-            if grad_scaler is None:
-                loss.backward()
-                opt.step()
-            else:
-                grad_scaler.scale(loss).backward()
-                grad_scaler.step(opt)
-                grad_scaler.update()
-
-            if scheduler and getattr(scheduler, '_update_per_step', False):
-                scheduler.step()
+        for X, y, _ in meter.batches(tq):
+            with meter.measure('h2d'):
+                inputs = [X[k].to(dev) for k in data_config.input_names]
+                raw_label = y[data_config.label_names[0]].long()
+                try:
+                    label_mask = y[data_config.label_names[0] + '_mask'].bool()
+                except KeyError:
+                    label_mask = None
+                label = _flatten_label(raw_label, label_mask)
+                num_examples = label.shape[0]
+                label_counter.update(label.cpu().numpy())
+                label = label.to(dev)
+                raw_label = raw_label.to(dev)
+            with meter.measure('model'):
+                model_output, logits, loss = accumulator.step(
+                    _loss_fn, inputs, [raw_label, label_mask], num_examples,
+                    last_batch=steps_per_epoch is not None and num_batches + 1 >= steps_per_epoch)
 
             _, preds = logits.max(1)
             loss = loss.item()
@@ -77,6 +243,8 @@ def train_classification(model, loss_func, opt, scheduler, train_loader, dev, ep
             total_loss += loss
             total_correct += correct
 
+            step_info = meter.step_end()
+
             tq.set_postfix({
                 'lr': '%.2e' % scheduler.get_last_lr()[0] if scheduler else opt.defaults['lr'],
                 'Loss': '%.5f' % loss,
@@ -88,6 +256,7 @@ def train_classification(model, loss_func, opt, scheduler, train_loader, dev, ep
                 tb_helper.write_scalars([
                     ("Loss/train", loss, tb_helper.batch_train_count + num_batches),
                     ("Acc/train", correct / num_examples, tb_helper.batch_train_count + num_batches),
+                    ("Stall/train", step_info['stall_fraction'], tb_helper.batch_train_count + num_batches),
                     ])
                 if tb_helper.custom_fn:
                     with torch.no_grad():
@@ -96,10 +265,14 @@ def train_classification(model, loss_func, opt, scheduler, train_loader, dev, ep
             if steps_per_epoch is not None and num_batches >= steps_per_epoch:
                 break
 
+    accumulator.flush()
+
     time_diff = time.time() - start_time
     _logger.info('Processed %d entries in total (avg. speed %.1f entries/s)' % (count, count / time_diff))
     _logger.info('Train AvgLoss: %.5f, AvgAcc: %.5f' % (total_loss / num_batches, total_correct / count))
     _logger.info('Train class distribution: \n    %s', str(sorted(label_counter.items())))
+    _report_timing(timer, meter, 'train', tb_helper, epoch)
+    _report_memory(getattr(train_loader.dataset, 'memory', None), dev, 'train', tb_helper, epoch)
 
     if tb_helper:
         tb_helper.write_scalars([
@@ -133,25 +306,29 @@ def evaluate_classification(model, test_loader, dev, epoch, for_training=True, l
     labels = defaultdict(list)
     labels_counts = []
     observers = defaultdict(list)
+    timer = getattr(test_loader.dataset, 'timer', None)
+    meter = StepMeter(dev, timer)
     start_time = time.time()
     with torch.no_grad():
         with tqdm.tqdm(test_loader) as tq:
-            for X, y, Z in tq:
-                inputs = [X[k].to(dev) for k in data_config.input_names]
-                label = y[data_config.label_names[0]].long()
-                entry_count += label.shape[0]
-                try:
-                    label_mask = y[data_config.label_names[0] + '_mask'].bool()
-                except KeyError:
-                    label_mask = None
-                if not for_training and label_mask is not None:
-                    labels_counts.append(np.squeeze(label_mask.numpy().sum(axis=-1)))
-                label = _flatten_label(label, label_mask)
-                num_examples = label.shape[0]
-                label_counter.update(label.cpu().numpy())
-                label = label.to(dev)
-                model_output = model(*inputs)
-                logits = _flatten_preds(model_output, label_mask).float()
+            for X, y, Z in meter.batches(tq):
+                with meter.measure('h2d'):
+                    inputs = [X[k].to(dev) for k in data_config.input_names]
+                    label = y[data_config.label_names[0]].long()
+                    entry_count += label.shape[0]
+                    try:
+                        label_mask = y[data_config.label_names[0] + '_mask'].bool()
+                    except KeyError:
+                        label_mask = None
+                    if not for_training and label_mask is not None:
+                        labels_counts.append(np.squeeze(label_mask.numpy().sum(axis=-1)))
+                    label = _flatten_label(label, label_mask)
+                    num_examples = label.shape[0]
+                    label_counter.update(label.cpu().numpy())
+                    label = label.to(dev)
+                with meter.measure('model'):
+                    model_output = model(*inputs)
+                    logits = _flatten_preds(model_output, label_mask).float()
 
                 scores.append(torch.softmax(logits, dim=1).detach().cpu().numpy())
                 for k, v in y.items():
@@ -169,6 +346,8 @@ def evaluate_classification(model, test_loader, dev, epoch, for_training=True, l
                 total_loss += loss * num_examples
                 total_correct += correct
 
+                meter.step_end()
+
                 tq.set_postfix({
                     'Loss': '%.5f' % loss,
                     'AvgLoss': '%.5f' % (total_loss / count),
@@ -187,6 +366,8 @@ def evaluate_classification(model, test_loader, dev, epoch, for_training=True, l
     time_diff = time.time() - start_time
     _logger.info('Processed %d entries in total (avg. speed %.1f entries/s)' % (count, count / time_diff))
     _logger.info('Evaluation class distribution: \n    %s', str(sorted(label_counter.items())))
+    _report_timing(timer, meter, 'eval' if for_training else 'test', tb_helper, epoch)
+    _report_memory(getattr(test_loader.dataset, 'memory', None), dev, 'eval' if for_training else 'test', tb_helper, epoch)
 
     if tb_helper:
         tb_mode = 'eval' if for_training else 'test'
@@ -272,11 +453,22 @@ def evaluate_onnx(model_path, test_loader, eval_metrics=['roc_auc_score', 'roc_a
     return total_correct / count, scores, labels, observers
 
 
-def train_regression(model, loss_func, opt, scheduler, train_loader, dev, epoch, steps_per_epoch=None, grad_scaler=None, tb_helper=None):
+def train_regression(model, loss_func, opt, scheduler, train_loader, dev, epoch, steps_per_epoch=None, grad_scaler=None, tb_helper=None,
+                     weight_averager=None, grad_accum_steps=1, micro_batch_size=None):
     model.train()
 
     data_config = train_loader.dataset.config
 
+    def _loss_fn(model_output, label):
+        # (keeps the batch dimension of single-entry micro-batches)
+        preds = model_output.squeeze(-1)
+        return preds, loss_func(preds, label), label.shape[0]
+
+    accumulator = _GradientAccumulator(model, opt, scheduler, grad_scaler=grad_scaler, weight_averager=weight_averager,
+                                       grad_accum_steps=grad_accum_steps, micro_batch_size=micro_batch_size)
+    timer = getattr(train_loader.dataset, 'timer', None)
+    meter = StepMeter(dev, timer)
+
     total_loss = 0
     num_batches = 0
     sum_abs_err = 0
@@ -284,26 +476,16 @@ def train_regression(model, loss_func, opt, scheduler, train_loader, dev, epoch,
     count = 0
     start_time = time.time()
     with tqdm.tqdm(train_loader) as tq:
-        for X, y, _ in tq:
-            inputs = [X[k].to(dev) for k in data_config.input_names]
-            label = y[data_config.label_names[0]].float()
-            num_examples = label.shape[0]
-            label = label.to(dev)
-            opt.zero_grad()
-            with torch.cuda.amp.autocast(enabled=grad_scaler is not None):
-                model_output = model(*inputs)
-                preds = model_output.squeeze()
-                loss = loss_func(preds, label)
-            if grad_scaler is None:
-                loss.backward()
-                opt.step()
-            else:
-                grad_scaler.scale(loss).backward()
-                grad_scaler.step(opt)
-                grad_scaler.update()
-
-            if scheduler and getattr(scheduler, '_update_per_step', False):
-                scheduler.step()
+        for X, y, _ in meter.batches(tq):
+            with meter.measure('h2d'):
+                inputs = [X[k].to(dev) for k in data_config.input_names]
+                label = y[data_config.label_names[0]].float()
+                num_examples = label.shape[0]
+                label = label.to(dev)
+            with meter.measure('model'):
+                model_output, preds, loss = accumulator.step(
+                    _loss_fn, inputs, [label], num_examples,
+                    last_batch=steps_per_epoch is not None and num_batches + 1 >= steps_per_epoch)
 
             loss = loss.item()
 
@@ -316,6 +498,8 @@ def train_regression(model, loss_func, opt, scheduler, train_loader, dev, epoch,
             sqr_err = e.square().sum().item()
             sum_sqr_err += sqr_err
 
+            step_info = meter.step_end()
+
             tq.set_postfix({
                 'lr': '%.2e' % scheduler.get_last_lr()[0] if scheduler else opt.defaults['lr'],
                 'Loss': '%.5f' % loss,
@@ -331,6 +515,7 @@ def train_regression(model, loss_func, opt, scheduler, train_loader, dev, epoch,
                     ("Loss/train", loss, tb_helper.batch_train_count + num_batches),
                     ("MSE/train", sqr_err / num_examples, tb_helper.batch_train_count + num_batches),
                     ("MAE/train", abs_err / num_examples, tb_helper.batch_train_count + num_batches),
+                    ("Stall/train", step_info['stall_fraction'], tb_helper.batch_train_count + num_batches),
                     ])
                 if tb_helper.custom_fn:
                     with torch.no_grad():
@@ -339,10 +524,14 @@ def train_regression(model, loss_func, opt, scheduler, train_loader, dev, epoch,
             if steps_per_epoch is not None and num_batches >= steps_per_epoch:
                 break
 
+    accumulator.flush()
+
     time_diff = time.time() - start_time
     _logger.info('Processed %d entries in total (avg. speed %.1f entries/s)' % (count, count / time_diff))
     _logger.info('Train AvgLoss: %.5f, AvgMSE: %.5f, AvgMAE: %.5f' %
                  (total_loss / num_batches, sum_sqr_err / count, sum_abs_err / count))
+    _report_timing(timer, meter, 'train', tb_helper, epoch)
+    _report_memory(getattr(train_loader.dataset, 'memory', None), dev, 'train', tb_helper, epoch)
 
     if tb_helper:
         tb_helper.write_scalars([
@@ -376,16 +565,20 @@ def evaluate_regression(model, test_loader, dev, epoch, for_training=True, loss_
     scores = []
     labels = defaultdict(list)
     observers = defaultdict(list)
+    timer = getattr(test_loader.dataset, 'timer', None)
+    meter = StepMeter(dev, timer)
     start_time = time.time()
     with torch.no_grad():
         with tqdm.tqdm(test_loader) as tq:
-            for X, y, Z in tq:
-                inputs = [X[k].to(dev) for k in data_config.input_names]
-                label = y[data_config.label_names[0]].float()
-                num_examples = label.shape[0]
-                label = label.to(dev)
-                model_output = model(*inputs)
-                preds = model_output.squeeze().float()
+            for X, y, Z in meter.batches(tq):
+                with meter.measure('h2d'):
+                    inputs = [X[k].to(dev) for k in data_config.input_names]
+                    label = y[data_config.label_names[0]].float()
+                    num_examples = label.shape[0]
+                    label = label.to(dev)
+                with meter.measure('model'):
+                    model_output = model(*inputs)
+                    preds = model_output.squeeze(-1).float()
 
                 scores.append(preds.detach().cpu().numpy())
                 for k, v in y.items():
@@ -405,6 +598,8 @@ def evaluate_regression(model, test_loader, dev, epoch, for_training=True, loss_
                 sqr_err = e.square().sum().item()
                 sum_sqr_err += sqr_err
 
+                meter.step_end()
+
                 tq.set_postfix({
                     'Loss': '%.5f' % loss,
                     'AvgLoss': '%.5f' % (total_loss / count),
@@ -425,6 +620,8 @@ def evaluate_regression(model, test_loader, dev, epoch, for_training=True, loss_
 
     time_diff = time.time() - start_time
     _logger.info('Processed %d entries in total (avg. speed %.1f entries/s)' % (count, count / time_diff))
+    _report_timing(timer, meter, 'eval' if for_training else 'test', tb_helper, epoch)
+    _report_memory(getattr(test_loader.dataset, 'memory', None), dev, 'eval' if for_training else 'test', tb_helper, epoch)
 
     if tb_helper:
         tb_mode = 'eval' if for_training else 'test'
@@ -0,0 +1,67 @@
+import copy
+import threading
+import torch
+
+from contextlib import nullcontext
+
+
+class BackgroundValidator(object):
+    r"""BackgroundValidator.
+
+    Runs the validation of an epoch on a snapshot of the model weights, on a separate device, in a background thread,
+    while the next epoch trains. The evaluation is dominated by the device kernels and the data loader workers, neither
+    of which holds the GIL, so the two overlap. At most one validation runs at a time: taking the next snapshot waits
+    for the previous validation to finish.
+
+    Arguments:
+        model (torch.nn.Module): the (unwrapped) model being trained; it is copied once to ``device``.
+        evaluate (callable): the evaluation function, called as ``evaluate(model, loader, device, epoch, **kwargs)``.
+        device (torch.device): device for the validation, e.g., a spare GPU or the CPU.
+        callback (callable, optional): called (in the background thread) as ``callback(epoch, metric, model)`` once the
+            validation of an epoch is done, e.g., to update the best epoch; ``model`` holds the validated weights.
+    """
+
+    def __init__(self, model, evaluate, device, callback=None):
+        self.source = model
+        self.model = copy.deepcopy(model).to(device)
+        self.evaluate = evaluate
+        self.device = device
+        self.callback = callback
+        self._thread = None
+        self._error = None
+
+    def submit(self, epoch, loader, weight_averager=None, **kwargs):
+        r"""Snapshot the current weights (the averaged ones if ``weight_averager``, tracking the same model, is set)
+        and start validating them."""
+        self.wait()
+        if weight_averager is not None:
+            weight_averager.swap()
+        try:
+            # copied to the validation device: the training can go on updating the weights in place
+            self.model.load_state_dict(self.source.state_dict())
+        finally:
+            if weight_averager is not None:
+                weight_averager.swap()
+        self._thread = threading.Thread(target=self._run, args=(epoch, loader), kwargs=kwargs,
+                                        name='validation-epoch-%d' % epoch, daemon=True)
+        self._thread.start()
+
+    def _run(self, epoch, loader, **kwargs):
+        try:
+            # the current CUDA device is per thread: select the validation one, so that the kernels, streams and events
+            # (e.g., the timing of `StepMeter`) of `evaluate` are on it, rather than on the training one (or cuda:0)
+            with torch.cuda.device(self.device) if self.device.type == 'cuda' else nullcontext():
+                metric = self.evaluate(self.model, loader, self.device, epoch, **kwargs)
+            if self.callback is not None:
+                self.callback(epoch, metric, self.model)
+        except BaseException as e:
+            self._error = e
+
+    def wait(self):
+        r"""Wait for the running validation (if any) to finish, and re-raise its error (if any)."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('The background validation failed') from error
@@ -0,0 +1,194 @@
+import time
+import threading
+import torch
+import torch.utils.data
+
+from contextlib import contextmanager
+from collections import defaultdict
+from .logger import _logger
+
+
+class _Record(object):
+    __slots__ = ('entries',)
+
+    def __init__(self, entries=0):
+        self.entries = entries
+
+
+class SharedCounters(object):
+    r"""SharedCounters.
+
+    Base class of the named counters living in shared memory, w/ one row per DataLoader worker (row 0 is the main
+    process), so the numbers recorded in the worker processes can be collected from the main process.
+
+    Arguments:
+        names (list): names of the counters.
+        num_fields (int): number of values kept for each counter.
+    """
+
+    max_workers = 64
+
+    def __init__(self, names, num_fields):
+        self._index = {n: i for i, n in enumerate(names)}
+        # (rows, counters, fields)
+        self._stats = torch.zeros((self.max_workers + 1, len(names), num_fields), dtype=torch.float64).share_memory_()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        # the counters must stay shared w/ all the copies of the dataset
+        return self
+
+    def _row(self):
+        worker_info = torch.utils.data.get_worker_info()
+        return 0 if worker_info is None else 1 + worker_info.id % self.max_workers
+
+    def _stat(self, name):
+        r"""The counter ``name`` of the current process."""
+        return self._stats[self._row(), self._index[name]]
+
+
+class StageTimer(SharedCounters):
+    r"""StageTimer.
+
+    Accumulates the wall time, the number of calls and the number of entries processed in each stage,
+    aggregated across the DataLoader worker processes (see ``SharedCounters``).
+
+    Arguments:
+        stages (list): names of the stages.
+    """
+
+    def __init__(self, stages):
+        self.stages = tuple(stages)
+        # [time, calls, entries]
+        super(StageTimer, self).__init__(self.stages, 3)
+
+    def add(self, stage, seconds, entries=0, calls=1):
+        stat = self._stat(stage)
+        with self._lock:
+            stat[0] += seconds
+            stat[1] += calls
+            stat[2] += entries
+
+    @contextmanager
+    def time(self, stage, entries=0):
+        r"""Time the enclosed block; the number of entries can also be set later on the yielded record."""
+        record = _Record(entries)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.add(stage, time.perf_counter() - start, record.entries)
+
+    def summary(self, reset=True):
+        totals = self._stats.sum(dim=0)
+        if reset:
+            self._stats.zero_()
+        return {s: {'time': float(t), 'calls': int(c), 'entries': int(e)}
+                for s, (t, c, e) in zip(self.stages, totals.tolist()) if c > 0}
+
+    def log_summary(self, name, summary):
+        if not summary:
+            return
+        _logger.info('Time per stage (%s), summed over all processes:\n%s', name, '\n'.join(
+            '    - %-16s %10.2f s  %8d calls  %12d entries  %10.1f entries/s' %
+            (s, v['time'], v['calls'], v['entries'], v['entries'] / v['time'] if v['time'] > 0 else 0)
+            for s, v in summary.items()))
+
+
+class TimedCollate(object):
+    r"""Wraps a ``collate_fn`` of the DataLoader to record the collation time."""
+
+    def __init__(self, timer, collate_fn=None):
+        if collate_fn is None:
+            from torch.utils.data._utils.collate import default_collate as collate_fn
+        self.timer = timer
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        with self.timer.time('collate', entries=len(batch)):
+            return self.collate_fn(batch)
+
+
+class StepMeter(object):
+    r"""StepMeter.
+
+    Measures, for every step of the train/eval loop, the time spent waiting for the next batch from the DataLoader,
+    copying it to the device (``h2d``) and running the model (``model``). On GPUs, the device time is measured
+    w/ CUDA events, so no extra synchronization is needed. The stall fraction is the fraction of the step time
+    spent waiting for data, and the busy fraction the fraction spent on the device.
+
+    Arguments:
+        dev (torch.device): the device the model runs on.
+        timer (StageTimer, optional): also accumulate the measured times into the ``data_wait``, ``h2d``
+            and ``model`` stages of this timer.
+    """
+
+    def __init__(self, dev, timer=None):
+        self.use_cuda = dev is not None and dev.type == 'cuda' and torch.cuda.is_available()
+        self.timer = timer
+        self.totals = defaultdict(float)
+        self._times = {}
+        self._events = {}
+        self._step_start = None
+
+    def batches(self, data_loader):
+        r"""Iterate over ``data_loader``, recording the time waiting for each batch."""
+        it = iter(data_loader)
+        while True:
+            self._step_start = time.perf_counter()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            self._times['data_wait'] = time.perf_counter() - self._step_start
+            yield batch
+
+    @contextmanager
+    def measure(self, stage):
+        if self.use_cuda:
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self._events[stage] = (start, end)
+        else:
+            start = time.perf_counter()
+            yield
+            self._times[stage] = time.perf_counter() - start
+
+    def step_end(self):
+        r"""Close the current step; returns the times (in seconds) and the stall/busy fractions of this step."""
+        for stage, (start, end) in self._events.items():
+            end.synchronize()
+            self._times[stage] = start.elapsed_time(end) / 1000.
+        self._events.clear()
+        result = dict(self._times)
+        self._times.clear()
+        result['step'] = time.perf_counter() - self._step_start
+        result['stall_fraction'] = result.get('data_wait', 0) / result['step']
+        result['busy_fraction'] = min(1., (result.get('h2d', 0) + result.get('model', 0)) / result['step'])
+        self.totals['num_steps'] += 1
+        for stage in ('data_wait', 'h2d', 'model', 'step'):
+            if stage in result:
+                self.totals[stage] += result[stage]
+                if self.timer is not None and stage != 'step':
+                    self.timer.add(stage, result[stage])
+        return result
+
+    def summary(self, reset=True):
+        totals = dict(self.totals)
+        if reset:
+            self.totals.clear()
+        if totals.get('step', 0) > 0:
+            totals['stall_fraction'] = totals.get('data_wait', 0) / totals['step']
+            totals['busy_fraction'] = min(1., (totals.get('h2d', 0) + totals.get('model', 0)) / totals['step'])
+        return totals